@@ -0,0 +1,275 @@
+'''
+local stand-in for the Aria server
+
+usage: python benchmarks/fake_aria.py [--port 8080] [--rate 1.0] [--burst 1] [--jitter 0]
+                                      [--drop-every 0]
+
+serves the control websocket on /player and the stream websocket on
+/stream, so config.json can point cmd_endpoint and stream_endpoint at
+ws://localhost:8080/player and ws://localhost:8080/stream.
+
+control: says hello with a key, answers search, list_queue, state,
+         playlists, playlist, token and invite, and broadcasts
+         event_queue_change / event_player_state_change when queue ops
+         change the fake queue
+stream:  expects the key as the first message, then sends opus frames
+         at `rate` times real time in bursts of `burst` frames, each burst
+         delayed by up to `jitter` ms
+drops:   every `drop_every` seconds, or on POST /drop?ctrl=1&stream=1, all
+         connections are closed as if the server restarted
+'''
+import argparse
+import asyncio
+import os
+import random
+import uuid
+
+from aiohttp import web
+
+FRAME_LENGTH = 0.02
+# a valid 20ms opus frame of silence
+OPUS_SILENCE = b'\xf8\xff\xfe'
+
+
+def fake_entry(n, source=None):
+    source = source or random.choice(('gpm', 'youtube'))
+    entry = {
+        'source': source,
+        'title': f'track {n}',
+        'uri': f'{source}:track:{n}',
+        'thumbnail': '',
+        'thumbnail_small': '',
+        'is_liked': n % 7 == 0,
+        'duration': 180 + n % 120,
+        'position': 0
+    }
+    if source == 'gpm':
+        entry['entry'] = {
+            'title': f'track {n}',
+            'artist': f'artist {n % 50}',
+            'album': f'album {n % 200}',
+            'user': f'user{n % 3}'
+        }
+    return entry
+
+
+class FakeAria:
+    def __init__(self, rate=1.0, burst=1, jitter=0.0, frame_bytes=0, queue_size=50, search_hits=30, drop_every=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.frame_bytes = frame_bytes
+        self.drop_every = drop_every
+        self.search_hits = search_hits
+        self.keys = set()
+        # websocket: its request, to reach the transport
+        self.ctrl_clients = {}
+        self.stream_clients = {}
+        self.queue = [fake_entry(n) for n in range(queue_size)]
+        self.state = 'playing'
+        self.ops_received = 0
+        self.frames_sent = 0
+        self.drops = 0
+        self.runner = None
+        self._dropper = None
+
+        self.app = web.Application()
+        self.app.router.add_get('/player', self.handle_ctrl)
+        self.app.router.add_get('/stream', self.handle_stream)
+        self.app.router.add_post('/drop', self.handle_drop)
+
+    async def start(self, host='127.0.0.1', port=0):
+        '''
+        Returns
+        -------
+        port: int, the port actually bound
+        '''
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        if self.drop_every:
+            self._dropper = asyncio.get_event_loop().create_task(self.drop_periodically())
+        return site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._dropper:
+            self._dropper.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+
+    def frame(self):
+        if self.frame_bytes:
+            return os.urandom(self.frame_bytes)
+        return OPUS_SILENCE
+
+    # drops
+
+    def drop(self, ctrl=True, stream=True):
+        '''
+        cut connections without a close handshake, like a crashed server
+        '''
+        requests = (list(self.ctrl_clients.values()) if ctrl else []) + \
+                   (list(self.stream_clients.values()) if stream else [])
+        for request in requests:
+            if request.transport:
+                request.transport.close()
+        self.drops += 1
+
+    async def drop_periodically(self):
+        while True:
+            await asyncio.sleep(self.drop_every)
+            self.drop()
+
+    async def handle_drop(self, request):
+        ctrl = request.query.get('ctrl', '1') == '1'
+        stream = request.query.get('stream', '1') == '1'
+        self.drop(ctrl, stream)
+        return web.Response(text=f'dropped ctrl={ctrl} stream={stream}')
+
+    # control
+
+    def now_playing(self):
+        return {'state': self.state, 'entry': self.queue[0] if self.queue else None}
+
+    def reply(self, op, data):
+        if op == 'search':
+            query = (data or {}).get('query', '')
+            return [fake_entry(hash(query) % 1000 + n) for n in range(self.search_hits)]
+        if op == 'list_queue':
+            return {'queue': self.queue}
+        if op == 'state':
+            return self.now_playing()
+        if op == 'playlists':
+            return {'playlists': [{'name': 'Likes', 'length': 42}, {'name': 'bench', 'length': 7}]}
+        if op == 'playlist':
+            return {'name': (data or {}).get('name'), 'entries': self.queue[:42]}
+        if op == 'token':
+            return {'token': uuid.uuid4().hex}
+        if op == 'invite':
+            return {'invite': uuid.uuid4().hex[:8]}
+        return None
+
+    def apply(self, op, data):
+        '''
+        Returns
+        -------
+        events: list of event types to broadcast
+        '''
+        data = data or {}
+        if op == 'queue':
+            uris = data.get('uri') or []
+            uris = uris if isinstance(uris, list) else [uris]
+            entries = [fake_entry(len(self.queue) + n) for n in range(len(uris))]
+            self.queue = entries + self.queue if data.get('head') else self.queue + entries
+            return ['event_queue_change']
+        if op == 'skip':
+            self.queue = self.queue[1:]
+            return ['event_queue_change', 'event_player_state_change']
+        if op in ('skip_to', 'remove'):
+            index = data.get('index', 0)
+            self.queue = self.queue[index:] if op == 'skip_to' else self.queue[:index] + self.queue[index + 1:]
+            return ['event_queue_change', 'event_player_state_change']
+        if op in ('pause', 'resume'):
+            self.state = 'paused' if op == 'pause' else 'playing'
+            return ['event_player_state_change']
+        if op in ('clear_queue', 'shuffle'):
+            if op == 'clear_queue':
+                self.queue = self.queue[:1]
+            else:
+                random.shuffle(self.queue)
+            return ['event_queue_change']
+        return []
+
+    async def broadcast(self, events):
+        for event in events:
+            data = {'queue': self.queue} if event == 'event_queue_change' else self.now_playing()
+            for ws in list(self.ctrl_clients):
+                await ws.send_json({'type': event, 'postback': 'None', 'data': data})
+
+    async def handle_ctrl(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        key = uuid.uuid4().hex
+        self.keys.add(key)
+        self.ctrl_clients[ws] = request
+        await ws.send_json({'type': 'hello', 'key': key, 'postback': 'None'})
+        try:
+            async for msg in ws:
+                if msg.type != web.WSMsgType.TEXT:
+                    continue
+                packet = msg.json()
+                self.ops_received += 1
+                op, data, postback = packet.get('op'), packet.get('data'), packet.get('postback')
+                result = self.reply(op, data)
+                if result is not None:
+                    await ws.send_json({'type': op, 'postback': postback, 'data': result})
+                await self.broadcast(self.apply(op, data))
+        finally:
+            self.ctrl_clients.pop(ws, None)
+            self.keys.discard(key)
+        return ws
+
+    # stream
+
+    async def handle_stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        msg = await ws.receive()
+        if msg.type != web.WSMsgType.TEXT or msg.data not in self.keys:
+            await ws.close()
+            return ws
+
+        self.stream_clients[ws] = request
+        sender = asyncio.get_event_loop().create_task(self.send_frames(ws))
+        try:
+            # read so a close from the client is answered
+            async for msg in ws:
+                pass
+        finally:
+            sender.cancel()
+            self.stream_clients.pop(ws, None)
+        return ws
+
+    async def send_frames(self, ws):
+        loop = asyncio.get_event_loop()
+        interval = FRAME_LENGTH * self.burst / self.rate
+        deadline = loop.time()
+        try:
+            while not ws.closed:
+                for _ in range(self.burst):
+                    await ws.send_bytes(self.frame())
+                    self.frames_sent += 1
+                deadline += interval
+                delay = deadline - loop.time()
+                if self.jitter:
+                    delay += random.uniform(0, self.jitter / 1000)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        except ConnectionResetError:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description='local stand-in for the Aria server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--rate', type=float, default=1.0, help='stream speed, 1.0 is real time')
+    parser.add_argument('--burst', type=int, default=1, help='frames sent back to back')
+    parser.add_argument('--jitter', type=float, default=0.0, help='max extra delay per burst in ms')
+    parser.add_argument('--frame-bytes', type=int, default=0, help='random frames of this size instead of silence')
+    parser.add_argument('--drop-every', type=float, default=0.0, help='close all connections every N seconds')
+    args = parser.parse_args()
+
+    server = FakeAria(args.rate, args.burst, args.jitter, args.frame_bytes, drop_every=args.drop_every)
+    loop = asyncio.get_event_loop()
+    port = loop.run_until_complete(server.start(args.host, args.port))
+    print(f'fake aria on ws://{args.host}:{port}/player and ws://{args.host}:{port}/stream')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
+
+if __name__ == '__main__':
+    main()
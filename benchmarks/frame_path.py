@@ -0,0 +1,113 @@
+'''
+micro-benchmark of the audio frame path, from websocket payload to sendto
+
+usage: python benchmarks/frame_path.py [frames]
+
+before: payload bytes go through an asyncio.Queue into discord.py's
+        VoiceClient.send_audio_packet, which builds a header, a SecretBox
+        and the packet for every frame
+after:  payload is copied into a JitterBuffer ring slot and FrameSender
+        encrypts and sends it in place
+
+needs discord.py and PyNaCl. the socket is a stub so only packet building
+is measured.
+'''
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import discord
+from frames import FrameSender
+from jitter_buffer import JitterBuffer
+
+FRAMES_PER_SECOND = 50
+
+
+class NullSocket:
+    def sendto(self, data, addr):
+        return len(data)
+
+
+class Encoder:
+    SAMPLES_PER_FRAME = 960
+
+
+class BenchVoice:
+    '''
+    just enough of a connected VoiceClient to run its packet code
+    '''
+    checked_add = discord.VoiceClient.checked_add
+    send_audio_packet = discord.VoiceClient.send_audio_packet
+    _get_voice_packet = discord.VoiceClient._get_voice_packet
+    _encrypt_xsalsa20_poly1305 = discord.VoiceClient._encrypt_xsalsa20_poly1305
+    _encrypt_xsalsa20_poly1305_suffix = discord.VoiceClient._encrypt_xsalsa20_poly1305_suffix
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.secret_key = list(os.urandom(32))
+        self.sequence = 0
+        self.timestamp = 0
+        self.ssrc = 1234
+        self._lite_nonce = 0
+        self.encoder = Encoder()
+        self.socket = NullSocket()
+        self.endpoint_ip = '127.0.0.1'
+        self.voice_port = 50000
+
+    def is_connected(self):
+        return True
+
+
+def before(mode):
+    voice = BenchVoice(mode)
+    queue = asyncio.Queue()
+    def step(payload):
+        queue.put_nowait(payload)
+        voice.send_audio_packet(queue.get_nowait(), encode=False)
+    return step
+
+def after(mode):
+    sender = FrameSender(BenchVoice(mode))
+    buffer = JitterBuffer(20, 20, 20)
+    def step(payload):
+        buffer.put_nowait(payload)
+        sender.send(buffer.get_nowait())
+    return step
+
+def measure(step, payloads):
+    start = time.process_time()
+    for payload in payloads:
+        step(payload)
+    cpu = (time.process_time() - start) / len(payloads)
+
+    # tracemalloc has no allocation counter, so sum the per-frame peak of
+    # short lived memory as an estimate of heap churn
+    tracemalloc.start()
+    churn = 0
+    for payload in payloads[:2000]:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        step(payload)
+        churn += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return cpu, churn / min(len(payloads), 2000)
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # typical 20ms opus frames at 64-128kbps
+    payloads = [os.urandom(160 + i % 160) for i in range(frames)]
+
+    for mode in ('xsalsa20_poly1305', 'xsalsa20_poly1305_suffix'):
+        print(mode)
+        for name, build in (('before', before), ('after', after)):
+            cpu, churn = measure(build(mode), payloads)
+            print(f'  {name:6}  cpu {cpu * 1e6:6.1f}us/frame  '
+                  f'churn {churn:6.0f}B/frame  {churn * FRAMES_PER_SECOND / 1024:6.1f}KiB/s per stream')
+
+if __name__ == '__main__':
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    main()
@@ -0,0 +1,100 @@
+'''
+benchmark of ctrl message decoding on a large list_queue reply
+
+usage: python benchmarks/json_codec.py [entries | recorded.json]
+
+before: msg.json() with the stdlib, then postback patched on the loop
+after:  codec.Codec with every json library installed, parsing on the
+        loop and in the default executor
+
+a recorded reply can be passed as a file, as it came off the ctrl socket;
+otherwise one is built from fake_aria entries. a 1ms ticker runs on the
+loop while decoding and its longest gap is how long the audio would stall.
+'''
+import asyncio
+import importlib
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import codec
+from fake_aria import fake_entry
+
+ROUNDS = 20
+
+
+def recorded(arg):
+    if os.path.isfile(arg):
+        with open(arg) as f:
+            return f.read()
+    random.seed(0)
+    queue = [fake_entry(n) for n in range(int(arg))]
+    return json.dumps({'type': 'list_queue', 'postback': '1234567890:42', 'data': {'queue': queue}})
+
+def before(payload):
+    res = json.loads(payload)
+    channel, _, req_id = str(res.get('postback')).partition(':')
+    try:
+        res['postback'] = int(channel)
+    except ValueError:
+        res['postback'] = None
+    return res, req_id
+
+async def ticker(gaps, stop):
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        gaps.append(now - last)
+        last = now
+
+async def measure(decode, payload):
+    stop = asyncio.Event()
+    gaps = []
+    tick = asyncio.ensure_future(ticker(gaps, stop))
+    await asyncio.sleep(0.01)
+    elapsed = 0.0
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        await decode(payload)
+        elapsed += time.perf_counter() - start
+        # messages arrive one by one, the loop runs in between
+        await asyncio.sleep(0.005)
+    elapsed /= ROUNDS
+    stop.set()
+    await tick
+    return elapsed, max(gaps)
+
+def backends():
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        yield name, module.loads
+
+async def main():
+    payload = recorded(sys.argv[1] if len(sys.argv) > 1 else '5000')
+    loop = asyncio.get_event_loop()
+    print(f'payload {len(payload) / 1024:.0f}KiB, {ROUNDS} rounds')
+
+    async def inline(data):
+        return before(data)
+    elapsed, gap = await measure(inline, payload)
+    print(f'  {"before":16}  {elapsed * 1000:6.2f}ms/msg  loop stalled up to {gap * 1000:5.1f}ms')
+
+    for name, loads in backends():
+        # codec.decode looks loads up on every call
+        codec.loads = loads
+        for where, offload in (('loop', 0), ('executor', 1)):
+            decoder = codec.Codec(loop, offload)
+            elapsed, gap = await measure(decoder.decode, payload)
+            print(f'  {name + " " + where:16}  {elapsed * 1000:6.2f}ms/msg  loop stalled up to {gap * 1000:5.1f}ms')
+
+if __name__ == '__main__':
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    asyncio.get_event_loop().run_until_complete(main())
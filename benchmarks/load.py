@@ -0,0 +1,254 @@
+'''
+end-to-end load benchmark against the local fake Aria server
+
+usage: python benchmarks/load.py [--seconds 10] [--commands 2000] [--rate 1.0]
+                                 [--burst 1] [--jitter 0] [--drop-every 0]
+                                 [--sessions 1] [--own-streams] [--json]
+                                 [--max-p99-ms N] [--max-jitter-ms N]
+
+runs Music, ws_ctrl and the stream hub the way run.py wires them, with a
+mocked voice client instead of discord, once per voice session with
+--sessions, and reports over all sessions:
+
+  command latency  Music.post to reply for state, list_queue and search,
+                   and Music.post to socket write
+  frame pacing     deviation of send intervals from 20ms
+  cpu / rss        process cpu time per second and resident memory
+  recovery         with --drop-every, time from a dropped websocket to a
+                   working one again
+  stream frames    frames the server sent; sessions share one music
+                   websocket unless --own-streams gives each its own token
+
+--max-p99-ms / --max-jitter-ms make it exit 1 when exceeded, for gating.
+'''
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import aiohttp
+from bot import Music
+from config import Config
+from fake_aria import FakeAria
+from gateway import Gateway
+from jitter_buffer import JitterBuffer
+from lifecycle import Lifecycle
+from metrics import Histogram
+from player import FrameScheduler, Player
+from stream_hub import StreamHub
+from supervisor import Supervisor
+from websocket_client import OpMux, ws_ctrl
+
+
+class NullSocket:
+    def __init__(self):
+        self.sent_at = []
+
+    def sendto(self, data, addr):
+        self.sent_at.append(time.perf_counter())
+        return len(data)
+
+
+class MockVoice:
+    '''
+    connected voice client that records when packets go out
+    '''
+    def __init__(self):
+        self.mode = 'xsalsa20_poly1305'
+        self.secret_key = list(os.urandom(32))
+        self.sequence = 0
+        self.timestamp = 0
+        self.ssrc = 1
+        self._lite_nonce = 0
+        self.socket = NullSocket()
+        self.endpoint_ip = '127.0.0.1'
+        self.voice_port = 50000
+
+    def is_connected(self):
+        return True
+
+    def checked_add(self, attr, value, limit):
+        val = getattr(self, attr) + value
+        setattr(self, attr, 0 if val > limit else val)
+
+    def send_audio_packet(self, data, *, encode=True):
+        self.socket.sendto(data, None)
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def merged(histograms):
+    total = Histogram()
+    for histogram in histograms:
+        total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+        total.count += histogram.count
+        total.sum += histogram.sum
+    return total
+
+def write_config(directory, port, sessions=1, own_streams=False):
+    path = os.path.join(directory, 'config.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'token': 'bench',
+            'aria_token': 'bench',
+            'cmd_endpoint': f'ws://127.0.0.1:{port}/player',
+            'stream_endpoint': f'ws://127.0.0.1:{port}/stream',
+            'voice_channel_id': '1',
+            'text_channel_id': '1',
+            'sessions': [{'voice_channel_id': str(n), 'text_channel_id': str(n),
+                          'aria_token': f'bench{n}' if own_streams else ''}
+                         for n in range(2, sessions + 1)]
+        }, f)
+    missing = os.path.join(directory, 'missing.json')
+    return Config(path, missing, missing, missing)
+
+# what the bot asks for most: now playing, the queue, and searches
+COMMANDS = (('state', None), ('list_queue', None), ('search', {'query': 'bench'}))
+
+async def drive_commands(sessions, count, seconds, concurrency=8):
+    '''
+    spread `count` queries over `seconds` and the sessions, and time each
+    one to its reply
+    '''
+    loop = asyncio.get_event_loop()
+    samples = []
+    window = asyncio.Semaphore(concurrency)
+    start = loop.time()
+    async def _one(n):
+        await asyncio.sleep(start + seconds * n / count - loop.time())
+        op, data = COMMANDS[n % len(COMMANDS)]
+        async with window:
+            started = time.perf_counter()
+            reply = await sessions[n // len(COMMANDS) % len(sessions)].post(op, data, 1, dispatch=False)
+            await reply
+            samples.append(time.perf_counter() - started)
+    await asyncio.gather(*[_one(n) for n in range(count)])
+    return samples
+
+async def bench(args):
+    loop = asyncio.get_event_loop()
+    server = FakeAria(args.rate, args.burst, args.jitter, args.frame_bytes, drop_every=args.drop_every)
+    port = await server.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = write_config(directory, port, args.sessions, args.own_streams)
+
+    supervisor = Supervisor(loop)
+    session = aiohttp.ClientSession()
+    gateway = Gateway(loop)
+    configs = config.session_configs()
+    scheduler = FrameScheduler(loop) if len(configs) > 1 else None
+    hub = StreamHub(session, loop, (config.reconnect_delay, config.reconnect_max_delay), config.stream_backlog_ms)
+    supervisor.on_shutdown(hub.close)
+    sessions, links = [], []
+    for config in configs:
+        lifecycle = Lifecycle(loop)
+        mux = OpMux(asyncio.Queue(), loop, config.op_timeout, config.max_pending_requests)
+        buffer = JitterBuffer(config.buffer_target_ms, config.buffer_low_ms, config.buffer_high_ms, loop)
+        player = Player(buffer, loop, lifecycle, scheduler)
+        music = Music(config, gateway, player, asyncio.Queue(), mux, lifecycle, loop)
+        gateway.add(music)
+        backoff = (config.reconnect_delay, config.reconnect_max_delay)
+        ctrl = ws_ctrl(mux, music.res_queue, session, config.cmd_endpoint, lifecycle, config.aria_token, loop, backoff)
+        stream = hub.subscribe(buffer, config.stream_endpoint, lifecycle, config.aria_token)
+
+        player.voice = MockVoice()
+        name = config.voice_channel_id
+        supervisor.add(f'responses:{name}', music.handle_res)
+        supervisor.add(f'ctrl:{name}', ctrl.link.run)
+        supervisor.add(f'music:{name}', stream.run)
+        lifecycle.mark('discord')
+        lifecycle.mark('listening')
+        player.start()
+        sessions.append(music)
+        links.append((ctrl, stream))
+
+    await asyncio.gather(*[music.lifecycle.wait('stream') for music in sessions])
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    samples = await drive_commands(sessions, args.commands, args.seconds)
+    cpu = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+    upstreams = list(hub.upstreams.values())
+
+    await supervisor.shutdown()
+    for music in sessions:
+        music.player.stop()
+    await session.close()
+    await server.stop()
+
+    deviation = []
+    for music in sessions:
+        sent = music.player.voice.socket.sent_at
+        deviation += [abs(b - a - 0.02) for a, b in zip(sent, sent[1:])]
+    buffers = [music.player.source.stats() for music in sessions]
+    return {
+        'sessions': len(sessions),
+        'commands': len(samples),
+        'cmd_p50_ms': percentile(samples, 0.5) * 1000,
+        'cmd_p90_ms': percentile(samples, 0.9) * 1000,
+        'cmd_p99_ms': percentile(samples, 0.99) * 1000,
+        'post_to_write': str(merged(ctrl.latency for ctrl, _ in links)),
+        'frames_sent': sum(music.player.frames_sent for music in sessions),
+        'frames_late': sum(music.player.frames_late for music in sessions),
+        'jitter_mean_ms': sum(deviation) / len(deviation) * 1000 if deviation else 0.0,
+        'jitter_p99_ms': percentile(deviation, 0.99) * 1000,
+        'jitter_max_ms': max(deviation) * 1000 if deviation else 0.0,
+        'buffer': {key: sum(stats[key] for stats in buffers) for key in ('underruns', 'overruns', 'pauses')},
+        'drops': server.drops,
+        'replayed': sum(ctrl.replayed for ctrl, _ in links),
+        'ctrl_recovery': str(merged(ctrl.link.recovery for ctrl, _ in links)),
+        'music_recovery': str(hub.recovery),
+        'upstreams': len(upstreams),
+        'stream_frames': server.frames_sent,
+        'stream_dropped': sum(stream.dropped for _, stream in links),
+        'cpu_percent': cpu * 100,
+        'rss_mb': rss_mb()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end load benchmark')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=1.0)
+    parser.add_argument('--burst', type=int, default=1)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--frame-bytes', type=int, default=0)
+    parser.add_argument('--drop-every', type=float, default=0.0)
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--own-streams', action='store_true')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--max-p99-ms', type=float)
+    parser.add_argument('--max-jitter-ms', type=float)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(bench(args))
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            print(f'{key:15} {value:.2f}' if isinstance(value, float) else f'{key:15} {value}')
+
+    failed = ((args.max_p99_ms is not None and result['cmd_p99_ms'] > args.max_p99_ms) or
+              (args.max_jitter_ms is not None and result['jitter_p99_ms'] > args.max_jitter_ms))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,52 @@
 import asyncio
+import functools
 import json
 import logging
 import random
 import re
-import textwrap
-import threading
 from sys import argv
 
-import discord
+from commands import CommandRegistry
 from config import Config
-from opus_loader import load_opus_libs
-
-lock = asyncio.Lock()
-
-class Music(discord.Client):
-    def __init__(self, config, player_queue, res_queue, ctrl_queue, loop):
-        super().__init__()
-        load_opus_libs()
+from dispatcher import Dispatcher
+from play_queue import PlayQueue
+from render import FragmentCache, list_entry, np_card, split
+from search_session import ResultCache, SearchSession
+from track import NO_TRACK, Track
+from voice_session import IdlePolicy, VoiceHealth
+
+class Music:
+    '''
+    one voice session: a voice channel and its text channel, played from
+    one aria
+
+    discord events come from the Gateway all sessions share.
+    '''
+    def __init__(self, config, gateway, player, res_queue, mux, lifecycle, loop):
         self.config = config
-        self.player_queue = player_queue
+        self.gateway = gateway
+        self.player = player
         self.res_queue = res_queue
-        self.ctrl_queue = ctrl_queue
+        self.mux = mux
+        self.lifecycle = lifecycle
         self.loop = loop
         self.voice = None
-        self.vc_members = 0
+        self.outbox = gateway.outbox
+        self.search_cache = ResultCache(loop, config.search_cache_size, config.search_cache_ttl)
+        self.health = VoiceHealth(self, player, loop, cooldown=config.voice_reconnect_cooldown)
+        self.idle = IdlePolicy(loop, config.idle_timeout, self.go_idle)
 
         self.player_status = {
             'state': False,
-            'source': None,
-            'title': None,
-            'album': None,
-            'artist': None,
-            'uri': None,
             'is_liked': False,
-            'duration': None,
-            'position': None
+            'position': None,
+            **NO_TRACK._asdict()
         }
-        self.play_queue = {}
+        self.play_queue = PlayQueue()
+        # the track in player_status
+        self.now_playing = NO_TRACK
+        self.list_entries = FragmentCache(list_entry)
+        self.np_cards = FragmentCache(np_card)
 
         self.nums = [
             ':one:',
@@ -80,92 +90,180 @@ class Music(discord.Client):
             'play_all': '\U0001F35C'
         }
 
+        self.commands = CommandRegistry(self, config.cmd_prefix, config.alias)
+
+        self.dispatcher = Dispatcher(loop)
+        self.dispatcher.add_pool('replies', 4)
+        self.dispatcher.add_pool('events', 1)
+        self.dispatcher.register('search', self.search, 'replies')
+        self.dispatcher.register('state', self.show_np, 'replies')
+        self.dispatcher.register('playlists', self.show_playlists, 'replies')
+        self.dispatcher.register('playlist', self.show_likelen, 'replies')
+        self.dispatcher.register('token', self.show_token, 'replies')
+        self.dispatcher.register('invite', self.show_invite, 'replies')
+        # both carry the whole queue, the newest one is the queue
+        self.dispatcher.register('list_queue', self.set_play_queue, 'events', latest_only=True, latest_key='queue')
+        self.dispatcher.register('event_queue_change', self.set_play_queue, 'events', latest_only=True,
+                                 latest_key='queue')
+        # carries the full player state, so only the newest one matters
+        self.dispatcher.register('event_player_state_change', self.set_player_status, 'events', latest_only=True)
+        self.dispatcher.register('event_playlists_change', None, 'events')
+        self.dispatcher.register('event_playlist_entry_change', None, 'events')
+
     async def on_ready(self):
-        logging.info('connected to discord')
+        logging.info(f'starting session for voice channel {self.config.voice_channel_id}')
         #await asyncio.wait_for(self.join_vc(), timeout=5.0)
         await self.join_vc()
-        await self.post('discord ready')
+        self.lifecycle.mark('discord')
         logging.info('discord vc connect')
-        response_handler = threading.Thread(target=self.handle_res, daemon=True)
-        self.vc_members = len(self.voice.channel.members)
-        self.loop.create_task(self._play())
-
-        response_handler.start()
+        self.player.start()
         logging.info('connected to vc')
+        await self.update_listeners()
 
-    async def safe_send(self, dest, payload, users=None):
+    async def safe_send(self, dest, payload, users=None, merge=True):
         '''
         Parameters
         ----------
         dest: discord.channel.TextChannel
         payload: str
         user: message.author
+        merge: bool, False if msg is edited, reacted to or deleted later
 
         Returns
         -------
-        msg
-        '''
-        try:
-            if users:
-                if not isinstance(users, (list, tuple)):
-                    users = [users]
-                msg = await dest.send(f'{" ".join([user.mention for user in users])}\n{payload}')
-            else:
-                msg = await dest.send(payload)
-        except discord.Forbidden:
-            logging.error('You do not have the proper permissions to send the message.')
-            return None
-        except discord.NotFound:
-            logging.error('dest channel is not found')
-            return None
-        except discord.HTTPException:
-            logging.error('Sending the message failed.')
+        msg: the first one if payload was too long for one message, None
+             if nothing was left to send
+        '''
+        if users:
+            if not isinstance(users, (list, tuple)):
+                users = [users]
+            payload = f'{" ".join([user.mention for user in users])}\n{payload}'
+        sent = [self.outbox.send(dest, chunk, merge) for chunk in split(payload)]
+        if not sent:
             return None
-        return msg
+        return (await asyncio.gather(*sent))[0]
 
     async def safe_delete(self, message):
-        try:
-            return await message.delete()
-        except discord.Forbidden:
-            logging.error('cannot delete message: no permission')
-        except discord.NotFound:
-            logging.error('cannot delete message: message not found')
+        if not message:
+            return
+        await self.outbox.delete(message)
 
     async def join_vc(self):
-        self.voice_channel = self.get_channel(self.config.voice_channel_id)
+        self.voice_channel = self.gateway.get_channel(self.config.voice_channel_id)
         self.voice = await self.voice_channel.connect()
+        self.player.voice = self.voice
+        self.idle.rejoined()
 
     async def exit_vc(self):
+        self.player.voice = None
         await self.voice.disconnect()
         self.voice = None
 
     async def cmd_reconnect(self, message=None, dest=None, cmd_args=[]):
         try:
             await asyncio.wait_for(self.exit_vc(), timeout=0.2)
-        except TimeoutError:
+        except asyncio.TimeoutError:
             logging.error('TimeoutError')
             return
         await self.join_vc()
 
     async def on_voice_state_update(self, member, before, after):
-        if not self.voice:
+        channel_id = self.config.voice_channel_id
+        was_in = before.channel is not None and before.channel.id == channel_id
+        is_in = after.channel is not None and after.channel.id == channel_id
+        if member == self.gateway.user or was_in == is_in:
             return
-        if self.vc_members != len(self.voice.channel.members):
-            if self.vc_members < len(self.voice.channel.members):
-                await self.cmd_reconnect()
-            self.vc_members = len(self.voice.channel.members)
+        if is_in and self.voice and self.voice.is_connected():
+            # announce our ssrc again so the newcomer hears us, no reconnect needed
+            await self.voice.ws.speak()
+        await self.update_listeners()
+
+    async def update_listeners(self):
+        '''
+        join and start streaming when someone is in the voice channel,
+        leave after idle_timeout once nobody is
+        '''
+        channel = self.gateway.get_channel(self.config.voice_channel_id)
+        listeners = len([member for member in channel.members if not member.bot])
+        if listeners:
+            # whether we are in the channel, not the stage, decides: the
+            # stage is still set while go_idle is leaving
+            if not self.voice:
+                await self.join_vc()
+            self.lifecycle.mark('listening')
+        self.idle.update(listeners)
+
+    async def go_idle(self):
+        logging.info('voice channel is empty, leaving and pausing the stream')
+        if self.voice:
+            await self.exit_vc()
+        self.lifecycle.clear('listening')
+        # someone may have joined while we were leaving; that update saw
+        # us still connected, so join again here
+        await self.update_listeners()
 
-    async def post(self, op, data=None, postback=None):
+    async def post(self, op, data=None, postback=None, dispatch=True):
         '''
         post op and message
+
+        Parameters
+        ----------
+        dispatch: bool, False to only deliver the response to the future
+
+        Returns
+        -------
+        future: asyncio.Future, resolves with the response for ops the
+                server answers, otherwise once its write to the socket starts
+        '''
+        return await self.mux.post(op, data, postback, dispatch)
+
+    async def post_batch(self, op, name, uris, dest):
         '''
-        async with lock:
-            self.ctrl_queue.put_nowait((op, data, postback))
+        post a playlist op for many uris
+
+        sends a single op with a uri list, like `queue` takes. with
+        `batch_ops` off in config, sends one op per uri instead, keeping at
+        most `max_inflight_ops` unsent, and reports once when all are out.
+
+        Parameters
+        ----------
+        op: str, add_to_playlist or remove_from_playlist
+        name: str, playlist name
+        uris: list
+        dest: discord.channel.TextChannel
+        '''
+        if not uris:
+            return
+        if self.config.batch_ops or len(uris) == 1:
+            await self.post(op, {'name': name, 'uri': uris if len(uris) > 1 else uris[0]}, dest.id)
+            return
+
+        window = asyncio.Semaphore(self.config.max_inflight_ops)
+        async def _post(uri):
+            async with window:
+                sent = await self.post(op, {'name': name, 'uri': uri})
+                try:
+                    await asyncio.wait_for(sent, timeout=10.0)
+                    return True
+                except asyncio.TimeoutError:
+                    return False
+
+        results = await asyncio.gather(*[_post(uri) for uri in uris])
+        done = results.count(True)
+        verb = 'added to' if op == 'add_to_playlist' else 'removed from'
+        res_text = f'**{done}** tracks {verb} **{name}**'
+        if done != len(uris):
+            res_text += f'\n**{len(uris) - done}** could not be sent'
+        await self.safe_send(dest, res_text)
 
     async def set_game_activity(self):
         '''
-        update game activity
+        update game activity, sent by the presence updater when the rate
+        limit allows. the bot has one presence, the first session shows
+        its track
         '''
+        if self.gateway.primary is not self:
+            return
         song = ''
         if self.player_status.get('state') != 'playing':
             song = u'\u275A\u275A'
@@ -180,52 +278,10 @@ class Music(discord.Client):
             song += f' / {self.player_status.get("artist")}'
 
 
-        playing_status = discord.Game(name=song)
-        await self.change_presence(activity=playing_status)
+        self.gateway.presence.update(song)
 
-    async def _play(self):
-        await lock.acquire()
-        if self.player_queue.empty():
-            lock.release()
-            await asyncio.sleep(0.001)
-        else:
-            if self.voice:
-                self.voice.send_audio_packet(self.player_queue.get_nowait(), encode=False)
-            lock.release()
-        self.loop.create_task(self._play())
-
-    def handle_res(self):
-        self.loop.create_task(self._handle_res())
-
-    async def _handle_res(self):
-        res = await self.res_queue.get()
-        response_type = res.get('type')
-        if response_type == 'search':
-            self.loop.create_task(self.search(res))
-        elif response_type == 'list_queue':
-            self.loop.create_task(self.set_play_queue(res))
-        elif response_type == 'state':
-            self.loop.create_task(self.show_np(res))
-        elif response_type == 'playlists':
-            self.loop.create_task(self.show_playlists(res))
-        elif response_type == 'playlist':
-            self.loop.create_task(self.show_likelen(res))
-        elif response_type == 'token':
-            self.loop.create_task(self.show_token(res))
-        elif response_type == 'invite':
-            self.loop.create_task(self.show_invite(res))
-        elif response_type == 'event_player_state_change':
-            self.loop.create_task(self.set_player_status(res))
-        elif response_type == 'event_queue_change':
-            self.loop.create_task(self.set_play_queue(res))
-        elif response_type == 'event_playlists_change':
-            pass
-        elif response_type == 'event_playlist_entry_change':
-            pass
-        else:
-            logging.warning('error: unexpected response type')
-
-        self.loop.create_task(self._handle_res())
+    async def handle_res(self):
+        await self.dispatcher.run(self.res_queue)
 
     async def set_player_status(self, res):
         '''
@@ -234,46 +290,24 @@ class Music(discord.Client):
         data = res.get('data')
         self.player_status['state'] = data.get('state')
         entry = data.get('entry')
-        if entry:
-            self.player_status['source'] = entry.get('source')
-            self.player_status['title'] = entry.get('title')
-            self.player_status['uri'] = entry.get('uri')
-            self.player_status['is_liked'] = entry.get('is_liked')
-            self.player_status['duration'] = entry.get('duration')
-            self.player_status['position'] = entry.get('position')
-            if self.player_status['source'] == 'gpm':
-                self.player_status['title'] = entry.get('entry').get('title')
-                self.player_status['album'] = entry.get('entry').get('album')
-                self.player_status['artist'] = entry.get('entry').get('artist')
-                self.player_status['user'] = entry.get('entry').get('user')
-            else:
-                self.player_status['album'] = None
-                self.player_status['artist'] = None
-        else:
-            self.player_status['source'] = None
-            self.player_status['title'] = None
-            self.player_status['title'] = None
-            self.player_status['album'] = None
-            self.player_status['artist'] = None
-            self.player_status['user'] = None
-            self.player_status['uri'] = None
-            self.player_status['is_liked'] = False
-            self.player_status['duration'] = None
-            self.player_status['position'] = None
+        if entry and entry.get('uri') != self.player_status.get('uri'):
+            # track changed: let the buffer fill up before playing it
+            self.player.rebuffer()
+        track = self.now_playing = Track.from_entry(entry) if entry else NO_TRACK
+        self.player_status.update(zip(track._fields, track))
+        self.player_status['is_liked'] = bool(entry and entry.get('is_liked'))
+        self.player_status['position'] = entry.get('position') if entry else None
 
         await self.set_game_activity()
 
         if self.player_status['state'] == 'stopped':
-            await lock.acquire()
-            while not self.player_queue.empty():
-                self.player_queue.get_nowait()
-            lock.release()
+            self.player.flush()
 
     async def set_play_queue(self, res):
         '''
-        update self.player_queue
+        update self.play_queue
         '''
-        self.play_queue = res
+        self.play_queue.update((res.get('data') or {}).get('queue'))
 
     async def search(self, raw_result):
         '''
@@ -283,106 +317,48 @@ class Music(discord.Client):
         ----------
         raw_result: dict
         '''
-        dest = self.get_channel(raw_result.get('postback') or self.config.text_channel_id)
-        results = await self.parse_result(raw_result)
+        dest = self.gateway.get_channel(raw_result.get('postback') or self.config.text_channel_id)
+        await self.show_search(dest, await self.parse_result(raw_result))
+
+    async def show_search(self, dest, results):
+        '''
+        let the user pick from results and queue the picks
+
+        Parameters
+        ----------
+        dest: discord.channel.TextChannel
+        results: list of parsed songs
+        '''
         if not results:
             res_text = f'Sorry\ncould not find any track'
             await self.safe_send(dest, res_text)
             return
 
-        res_text = (f'**search result**\n'
-                    f'**{len(results)}** hits')
-        await self.safe_send(dest, res_text)
-
-        res_count = self.config.serch_result_count
-        total_page = -(-len(results) // res_count)
-        result = results
-        to_play = []
-
-        async def _send():
-            if to_play:
-                if len(to_play) == 1:
-                    await self.post('queue', {'uri': to_play[0]})
-                else:
-                    await self.post('queue', {'uri': to_play})
-
-        for page in range(total_page):
-            res_text = f'page: {page+1} / {total_page}\n'
-            show = result[0:len(result) if len(result) < res_count else res_count]
-            result = result[len(show):]
-            res_text += await self.format_list(show, 'search')
-            #r = re.compile(key, re.IGNORECASE)
-            #res_text = re.sub(r, f'**{key}**', res_text)
-            msg = await self.safe_send(dest, res_text)
-
-            for i in range(len(show)):
-                self.loop.create_task(msg.add_reaction(self.unicode_nums[i]))
-            if page+1 != total_page:
-                self.loop.create_task(msg.add_reaction(self.control['fast_forward']))
-            for i in ['no_entry_sign', 'white_check_mark', 'play_all']:
-                self.loop.create_task(msg.add_reaction(self.control[i]))
-
-            def check(reaction, user):
-                return user != msg.author and reaction.message.id == msg.id
-
-            next_page = False
-            while True:
-                try:
-                    reaction, _ = await self.wait_for('reaction_add', timeout=60.0, check=check)
-
-                    if str(reaction.emoji) == self.control['fast_forward']: #go next page
-                        await self.safe_delete(msg)
-                        next_page = True
-                        break
-                    elif str(reaction.emoji) == self.control['no_entry_sign']: #cancel
-                        await self.safe_delete(msg)
-                        return
-                    elif str(reaction.emoji) == self.control['white_check_mark']: #submit
-                        await self.safe_delete(msg)
-                        break
-                    elif str(reaction.emoji) == self.control['play_all']: #play all
-                        await self.safe_delete(msg)
-                        to_play.clear()
-                        to_play = [i.get('uri') for i in results]
-                        break
-
-                    select = self.inv_unicode_nums.get(str(reaction.emoji))
-                    if select:
-                        to_play.append(show[select-1].get('uri'))
-                except asyncio.TimeoutError:
-                    await self.safe_delete(msg)
-                    return
-
-            if next_page and page != total_page:
-                continue
+        session = SearchSession(self, dest, results, self.config.serch_result_count,
+                                lambda show: self.format_list(show, 'search'))
+        to_play = await session.run()
+        if to_play:
+            if len(to_play) == 1:
+                await self.post('queue', {'uri': to_play[0]})
             else:
-                break
-
-        await _send()
+                await self.post('queue', {'uri': to_play})
 
     async def show_np(self, res):
-        dest = self.get_channel(res.get('postback') or self.config.text_channel_id)
+        dest = self.gateway.get_channel(res.get('postback') or self.config.text_channel_id)
         try:
             await asyncio.wait_for(self.set_player_status(res), timeout=1.0)
-            res_text = ''
-            if self.player_status.get('state') == 'playing':
-                res_text = f':arrow_forward: **{self.player_status.get("title")}\n\n**'
-            else:
-                res_text = f':pause_button: **{self.player_status.get("title")}\n\n**'
-            if self.player_status.get('source') == 'gpm':
-                res_text += (f'        album: **{self.player_status.get("album")}**\n'
-                            f'        artist: **{self.player_status.get("artist")}**\n'
-                            '        from: **gpm**\n'
-                            f'        owner: **{self.player_status.get("user")}**\n'
-                            f'        uri: {self.player_status.get("uri")}\n')
-            else:
-                res_text += (f'        from: **{self.player_status.get("source")}**\n'
-                            f'        uri: <{self.player_status.get("uri")}>\n')
+            track = self.now_playing
+            icon = ':arrow_forward:' if self.player_status.get('state') == 'playing' else ':pause_button:'
 
             def _format_time (song_len):
                 return f'{int(song_len/60)}:{int(song_len%60)}'
 
-            res_text += f'        position: {_format_time(self.player_status.get("position"))} / {_format_time(self.player_status.get("duration"))}'
+            res_text = ''.join((
+                f'{icon} **{track.title}\n\n**',
+                # the card only changes with the track
+                self.np_cards.get(track),
+                f'        position: {_format_time(self.player_status.get("position"))} / {_format_time(track.duration)}'
+            ))
             await self.safe_send(dest, res_text)
         except TimeoutError:
             logging.error('TimeoutError')
@@ -398,132 +374,79 @@ class Music(discord.Client):
 
         Returns
         -------
-        songs: list
-        '''
-        if not res.get('data'):
-            #0hit
-            return None
-
-        songs = []
-        # for entry in res.get('data').get('result') or res.get('data').get('queue'):
-        for entry in res.get('data'):
-            song = {}
-            song['source'] = entry.get('source')
-            song['title'] = entry.get('title')
-            if entry.get('entry'):
-                song['title'] = entry.get('entry').get('title')
-                song['artist'] = entry.get('entry').get('artist')
-                song['album'] = entry.get('entry').get('album')
-                song['user'] = entry.get('entry').get('user')
-            song['uri'] = entry.get('uri')
-            song['thumbnail'] = entry.get('thumbnail_small')
-            songs.append(song)
-        return songs
-
-    async def parse_queue(self, res):
-        '''
-        fetch play que
-
-        Paramters
-        ---------
-        res: dict
-
-        Returns
-        -------
-        songs: list
+        songs: list of Track
         '''
         if not res.get('data'):
             #0hit
             return None
 
-        songs = []
-        for entry in res.get('data').get("queue"):
-            song = {}
-            song['source'] = entry.get('source')
-            song['title'] = entry.get('title')
-            if entry.get('entry'):
-                song['title'] = entry.get('entry').get('title')
-                song['artist'] = entry.get('entry').get('artist')
-                song['album'] = entry.get('entry').get('album')
-                song['user'] = entry.get('entry').get('user')
-            song['uri'] = entry.get('uri')
-            song['thumbnail'] = entry.get('thumbnail_small')
-            songs.append(song)
-        return songs
+        return [Track.from_entry(entry) for entry in res.get('data')]
 
     async def show_playlists(self, res):
-        _playlists = {}
-        dest = self.get_channel(res.get('postback') or self.config.text_channel_id)
-
-        for entry in res.get('data').get('playlists'):
-            _playlists[entry.get('name')] = entry.get('length')
+        dest = self.gateway.get_channel(res.get('postback') or self.config.text_channel_id)
 
-        res_text = ''
-        res_text = 'playlist\n\n'
-        for i in _playlists:
-            res_text += f':file_folder: **{i}** has **{_playlists[i]}** tracks :musical_note:\n'
-        res_text += '\nmore info use web client'
+        _playlists = {entry.get('name'): entry.get('length') for entry in res.get('data').get('playlists')}
+        lines = [f':file_folder: **{name}** has **{length}** tracks :musical_note:' for name, length in _playlists.items()]
+        res_text = '\n'.join(('playlist', '', *lines, '', 'more info use web client'))
 
         await self.safe_send(dest, res_text)
 
     async def show_likelen(self, res):
-        dest = self.get_channel(res.get('postback') or self.config.text_channel_id)
+        dest = self.gateway.get_channel(res.get('postback') or self.config.text_channel_id)
 
         lenlist = len(res.get('data').get('entries'))
 
         await self.safe_send(dest, f'Likes has **{lenlist}** tracks :musical_note: \nmore info use web client')
 
     async def show_token(self, res):
-        dest = self.get_channel(res.get('postback') or self.config.text_channel_id)
+        dest = self.gateway.get_channel(res.get('postback') or self.config.text_channel_id)
         token = res.get('data').get('token')
-        msg_id = await self.safe_send(dest, f'Your TOKEN : **{token}**')
-        await asyncio.sleep(60)
-        await self.safe_delete(msg_id)
+        msg = await self.safe_send(dest, f'Your TOKEN : **{token}**', merge=False)
+        if msg:
+            self.outbox.delete(msg, 60)
 
     async def show_invite(self, res):
-        dest = self.get_channel(res.get('postback') or self.config.text_channel_id)
+        dest = self.gateway.get_channel(res.get('postback') or self.config.text_channel_id)
         invite = res.get('data').get('invite')
-        msg_id = await self.safe_send(dest, f'Your invite link : https://aria.gaiji.pro/auth/github/register?invite={invite}')
-        await asyncio.sleep(60)
-        await self.safe_delete(msg_id)
-
-    async def gen_command_list(self):
-        self.commandlist = []
-        for attr in dir(self):
-            if attr.startswith('cmd_'):
-                self.commandlist.append(self.config.cmd_prefix+attr[4:])
+        msg = await self.safe_send(dest, f'Your invite link : https://aria.gaiji.pro/auth/github/register?invite={invite}', merge=False)
+        if msg:
+            self.outbox.delete(msg, 60)
 
     async def format_list(self, orig_list, opr):
-        numberd_list = ''
+        numberd_list = []
         if opr == 'queue':
             if self.player_status.get('state') == 'playing':
-                numberd_list = f':arrow_forward: **{self.player_status.get("title")}**\n'
+                numberd_list.append(f':arrow_forward: **{self.player_status.get("title")}**\n')
             else:
-                numberd_list = f':pause_button: **{self.player_status.get("title")}**\n'
+                numberd_list.append(f':pause_button: **{self.player_status.get("title")}**\n')
             if self.player_status.get('source') == 'gpm':
-                numberd_list += f'        {self.player_status.get("album")} / {self.player_status.get("artist")}\n\n'
+                numberd_list.append(f'        {self.player_status.get("album")} / {self.player_status.get("artist")}\n\n')
             else:
-                numberd_list += '\n'
-            numberd_list += f'**{len(orig_list)}** tracks in queue\n\n'
+                numberd_list.append('\n')
+            numberd_list.append(f'**{len(orig_list)}** tracks in queue\n\n')
         for num, song in zip(self.nums, orig_list):
-            if song['source'] == 'gpm':
-                numberd_list += (f'{num} **{song["title"]}**\n'
-                                f'        {song["album"]} / {song["artist"]}\n'
-                                f'        from: gpm - {song["user"]}\n')
-            else:
-                numberd_list += (f'{num} **{song["title"]}**\n'
-                                f'        - from: {song["source"]}\n')
+            numberd_list += (num, self.list_entries.get(song))
 
-        return numberd_list
+        return ''.join(numberd_list)
 
     def op_only(func):
+        @functools.wraps(func)
         async def wrapper(self, *args, **kwargs):
             #print(args[0].author.id)
             if args[0].author.id in self.config.op:
                 return await func(self, *args, **kwargs)
             else:
                 return await self.safe_send(args[0].channel ,':regional_indicator_f: :regional_indicator_u: :regional_indicator_c: :regional_indicator_k: :regional_indicator_y: :regional_indicator_o: :regional_indicator_u:', args[0].author.mention)
+        wrapper.op_only = True
         return wrapper
+
+    def exact_only(func):
+        '''
+        commands that throw away queue state run only when typed in full or
+        by alias, never from a prefix a typo could also be
+        '''
+        func.exact_only = True
+        return func
     ##########################
     async def cmd_play(self, message, dest, *cmd_args):
         '''
@@ -578,7 +501,7 @@ class Music(discord.Client):
         '''
         if not self.player_status.get('state') == 'playing':
             #pausing
-            await dest.send('error:anger:\nplayer is already paused')
+            await self.safe_send(dest, 'error:anger:\nplayer is already paused')
             return
         else:
             await self.post('pause', postback=dest.id)
@@ -591,11 +514,12 @@ class Music(discord.Client):
         '''
         if self.player_status.get('state') == 'playing':
             #playing
-            await dest.send('error:anger:\nplayer is already playing')
+            await self.safe_send(dest, 'error:anger:\nplayer is already playing')
             return
         else:
             await self.post('resume', postback=dest.id)
 
+    @exact_only
     async def cmd_skip(self, message, dest, *cmd_args):
         '''
         skip
@@ -607,6 +531,7 @@ class Music(discord.Client):
             return
         await self.cmd_skip_to(message, dest, *cmd_args)
 
+    @exact_only
     async def cmd_skip_to(self, message, dest, *cmd_args):
         '''
         skip to selected entry
@@ -620,8 +545,9 @@ class Music(discord.Client):
             return
         try:
             index = int(cmd_args[0]) - 1
-            if index <= len(self.play_queue.get('data').get('queue')):
-                await self.post('skip_to', {'index': index, 'uri': self.play_queue.get('data').get('queue')[index].get('uri')}, dest.id)
+            track = self.play_queue.track_at(index)
+            if track:
+                await self.post('skip_to', {'index': index, 'uri': track.uri}, dest.id)
             else:
                 await self.safe_send(dest, f'{index+1} is out of queue range')
         except ValueError:
@@ -633,12 +559,13 @@ class Music(discord.Client):
 
         usage {prefix}queue
         '''
-        result = await self.parse_queue(self.play_queue)
-        if not result:
+        if not self.play_queue:
             res_text = f'No tracks in queue'
             await self.safe_send(dest, res_text)
             return
-        res_text = await self.format_list(result, 'queue')
+        # the header shows the current track
+        status = tuple(self.player_status.get(key) for key in ('state', 'title', 'source', 'album', 'artist'))
+        res_text = await self.play_queue.view(status, lambda queue: self.format_list(queue, 'queue'))
         await self.safe_send(dest, res_text)
 
 
@@ -649,7 +576,7 @@ class Music(discord.Client):
         usage {prefix}playnext URL
         '''
         if len(cmd_args) != 1:
-            await dest.send('error:anger:\n usage `{prefix}playnext URL`'.format(prefix=self.config.cmd_prefix))
+            await self.safe_send(dest, 'error:anger:\n usage `{prefix}playnext URL`'.format(prefix=self.config.cmd_prefix))
             return
         await self.post('queue', {'uri': cmd_args[0], 'head': True}, dest.id)
 
@@ -660,20 +587,12 @@ class Music(discord.Client):
         usage {prefix}add URL(s)
         '''
         if not cmd_args:
-            await dest.send('error:anger:\n usage `{prefix}add URL(s)`'.format(prefix=self.config.cmd_prefix))
+            await self.safe_send(dest, 'error:anger:\n usage `{prefix}add URL(s)`'.format(prefix=self.config.cmd_prefix))
             return
-        if len(cmd_args) == 1:
-            if cmd_args[0][0] == '<':
-                await self.post('add_to_playlist', {'name': 'Likes', 'uri':cmd_args[0][1:-1]}, dest.id)
-            else:
-                await self.post('add_to_playlist', {'name': 'Likes', 'uri':cmd_args[0]}, dest.id)
-        else:
-            for i in cmd_args:
-                if i[0] == '<':
-                    await self.post('add_to_playlist', {'name': 'Likes', 'uri':i[1:-1]}, dest.id)
-                else:
-                    await self.post('add_to_playlist', {'name': 'Likes', 'uri':i}, dest.id)
+        uris = [i if i[0] != '<' else i[1:-1] for i in cmd_args]
+        await self.post_batch('add_to_playlist', 'Likes', uris, dest)
 
+    @exact_only
     async def cmd_remove(self, message, dest, *cmd_args):
         '''
         remove from queue
@@ -681,14 +600,15 @@ class Music(discord.Client):
         usage {prefix}remove num
         '''
         if not cmd_args:
-            await dest.send('error:anger:\nusage `{prefix}remove URL(s)`'.format(prefix=self.config.cmd_prefix))
+            await self.safe_send(dest, 'error:anger:\nusage `{prefix}remove URL(s)`'.format(prefix=self.config.cmd_prefix))
             return
         try:
             index = int(cmd_args[0]) - 1
-            if index <= len(self.play_queue):
-                await self.post('remove', {'index': index, 'uri': self.play_queue.get('data').get('queue')[index].get('uri')}, dest.id)
+            track = self.play_queue.track_at(index)
+            if track:
+                await self.post('remove', {'index': index, 'uri': track.uri}, dest.id)
             else:
-                await self.safe_send(dest, f'{index} is out of queue range')
+                await self.safe_send(dest, f'{index+1} is out of queue range')
         except ValueError:
             await self.safe_send(dest, 'error:anger:\n usage `{prefix}remove num`'.format(prefix=self.config.cmd_prefix))
 
@@ -736,6 +656,7 @@ class Music(discord.Client):
             return
         await self.post('create_playlist', {'name': cmd_args[0]}, dest.id)
 
+    @exact_only
     async def cmd_clear(self, message, dest, *cmd_args):
         '''
         clear queue
@@ -744,6 +665,7 @@ class Music(discord.Client):
         '''
         await self.post('clear_queue', postback=dest.id)
 
+    @exact_only
     async def cmd_shuffle(self, message, dest, *cmd_args):
         '''
         shuffle queue
@@ -752,6 +674,7 @@ class Music(discord.Client):
         '''
         await self.post('shuffle', postback=dest.id)
 
+    @exact_only
     async def cmd_purge(self, message, dest, *cmd_args):
         '''
         remove from auto playlist
@@ -764,8 +687,8 @@ class Music(discord.Client):
             else:
                 await self.safe_send(dest, 'error:anger:\nThis track is not in Likes')
             return
-        for url in cmd_args:
-            await self.post('remove_from_playlist', {'name':'Likes', 'uri': url}, dest.id)
+        uris = [i if i[0] != '<' else i[1:-1] for i in cmd_args]
+        await self.post_batch('remove_from_playlist', 'Likes', uris, dest)
 
     async def cmd_save(self, message, dest, *cmd_args):
         '''
@@ -808,14 +731,26 @@ class Music(discord.Client):
         search
         '''
         if not cmd_args:
-            await dest.send('error:anger:\nusage `{prefix}search keyword`'.format(prefix=self.config.cmd_prefix))
+            await self.safe_send(dest, 'error:anger:\nusage `{prefix}search keyword`'.format(prefix=self.config.cmd_prefix))
             return
 
         query = ' '.join(cmd_args)
-        if provider:
-            await self.post('search', {'query': query, 'provider': provider}, dest.id)
-        else:
-            await self.post('search', {'query': query}, dest.id)
+        key = self.search_cache.key(provider, query)
+        results = self.search_cache.get(key)
+        if results is None:
+            if provider:
+                reply = await self.post('search', {'query': query, 'provider': provider}, dest.id, dispatch=False)
+            else:
+                reply = await self.post('search', {'query': query}, dest.id, dispatch=False)
+            try:
+                res = await reply
+            except asyncio.TimeoutError:
+                await self.safe_send(dest, 'error:anger:\nsearch timed out')
+                return
+            results = await self.parse_result(res)
+            if results:
+                self.search_cache.put(key, results)
+        await self.show_search(dest, results)
 
     async def cmd_s(self, message, dest, *cmd_args):
         if not cmd_args:
@@ -835,7 +770,7 @@ class Music(discord.Client):
         usage {prefix}join
         '''
         if self.voice:
-            await dest.send(f'{self.user} is already in VC')
+            await self.safe_send(dest, f'{self.gateway.user} is already in VC')
             return
         await self.join_vc()
 
@@ -847,7 +782,7 @@ class Music(discord.Client):
         usage {prefix}kick
         '''
         if not self.voice:
-            await dest.send(f'{self.user} is not in VC')
+            await self.safe_send(dest, f'{self.gateway.user} is not in VC')
             return
         await self.exit_vc()
 
@@ -859,7 +794,7 @@ class Music(discord.Client):
         usage {prefix}logout
         '''
         await self.safe_delete(message)
-        await self.logout()
+        await self.gateway.logout()
         exit(1)
 
     async def cmd_show_alias(self, message, dest, *cmd_args):
@@ -868,15 +803,44 @@ class Music(discord.Client):
 
         usage {prefix}show_alias
         '''
-        res_text = ''
         if self.config.alias:
-            res_text = 'alias\n\n'
-            for i in self.config.alias:
-                res_text += f'`{i}` is`{self.config.alias[i]}`\n'
+            lines = [f'`{name}` is`{command}`' for name, command in self.config.alias.items()]
+            res_text = '\n'.join(('alias', '', *lines))
         else:
             res_text = 'command alias does not exist\nedit `config/alias.json`'
         await self.safe_send(dest, res_text)
 
+    @op_only
+    async def cmd_perf(self, message, dest, *cmd_args):
+        '''
+        [operator only]what blocked the event loop, most time first
+
+        usage {prefix}perf [number to show its stack]
+        '''
+        watchdog = self.gateway.watchdog
+        if not watchdog:
+            await self.safe_send(dest, 'loop watchdog is off\nset `watchdog_ms` in `config/config.json`')
+            return
+        top = watchdog.top()
+        if cmd_args:
+            try:
+                handler, count, total, worst = top[int(cmd_args[0]) - 1]
+            except (ValueError, IndexError):
+                await self.safe_send(dest, f'error:anger:\nusage `{self.config.cmd_prefix}perf [1-{len(top)}]`')
+                return
+            stack = ''.join(worst.stack) if worst.stack else 'no stack, the loop did not let go of the GIL'
+            await self.safe_send(dest, f'{handler}, worst {worst.duration * 1000:.0f}ms\n```{stack}```')
+            return
+
+        lines = [f'loop lag {name}: {lag}' for name, lag in watchdog.stats()['lag'].items()]
+        lines.append('')
+        if top:
+            lines += [f'{n}. `{handler}` {count}x, {total * 1000:.0f}ms, worst {worst.duration * 1000:.0f}ms'
+                      for n, (handler, count, total, worst) in enumerate(top, 1)]
+        else:
+            lines.append(f'nothing blocked the loop for {watchdog.threshold * 1000:.0f}ms or more')
+        await self.safe_send(dest, '\n'.join(lines))
+
     @op_only
     async def cmd_reload_alias(self, message, dest, *cmd_args):
         '''
@@ -886,7 +850,10 @@ class Music(discord.Client):
         '''
         try:
             with open('config/alias.json', 'r') as f:
-                self.config.alias = json.load(f)
+                alias = json.load(f)
+            for music in self.gateway.sessions:
+                music.commands.rebuild(alias)
+                music.config.alias = alias
             await self.safe_send(dest, 'alias is updated')
         except FileNotFoundError:
             logging.error('alias file does not exist')
@@ -900,9 +867,9 @@ class Music(discord.Client):
         target = message.mentions or [message.author]
         fuck_str = ':regional_indicator_f: :regional_indicator_u: :regional_indicator_c: :regional_indicator_k: :regional_indicator_y: :regional_indicator_o: :regional_indicator_u: '
         fuck_emote = ['\U0001F1EB', '\U0001F1FA', '\U0001F1E8', '\U0001F1F0', '\U0001F595']
-        msg = await self.safe_send(dest, fuck_str, target)
-        for emote in fuck_emote:
-            self.loop.create_task(msg.add_reaction(emote))
+        msg = await self.safe_send(dest, fuck_str, target, merge=False)
+        if msg:
+            self.outbox.react(msg, fuck_emote)
 
     async def cmd_potg(self, message, dest, *cmd_args):
         await self.safe_delete(message)
@@ -959,25 +926,15 @@ class Music(discord.Client):
         usage {prefix}help
         '''
         if cmd_args:
-            handler = getattr(self, f'cmd_{cmd_args[0]}', None)
-            if handler:
-                res_text = (f'Command: **{cmd_args[0]}**'
-                            f'```{textwrap.dedent(handler.__doc__.format(prefix=self.config.cmd_prefix))}```')
-                await self.safe_send(dest, res_text)
-                return
-            elif self.config.alias.get(cmd_args[0]):
-                alias = self.config.alias.get(cmd_args[0])
-                handler = getattr(self, f'cmd_{alias}', None)
-                res_text = (f'Command: **{cmd_args[0]}**'
-                            f'```{textwrap.dedent(handler.__doc__.format(prefix=self.config.cmd_prefix))}```')
+            command = self.commands.lookup(cmd_args[0].lower())
+            if command:
+                res_text = (f'Command: **{command.name}**'
+                            f'```{command.doc or "no description"}```')
                 await self.safe_send(dest, res_text)
                 return
 
-        await self.gen_command_list()
-        print_text = 'available commands\nmore info `.help [command]` ```'
-        for cmd in self.commandlist:
-            print_text += f'{cmd}, '
-        print_text += '```'
+        names = ', '.join(self.config.cmd_prefix + name for name in self.commands.names)
+        print_text = f'available commands\nmore info `.help [command]` ```{names}```'
         await self.safe_send(dest, print_text)
 
     async def cmd_save_que(self, mesasge, dest, *cmd_args):
@@ -989,10 +946,7 @@ class Music(discord.Client):
         playlist = ' '.join(cmd_args) or 'Likes'
         # TODO: check playlist valid
 
-        _que =  await self.parse_queue(self.play_queue)
-        for song in _que:
-            _uri = song['uri']
-            await self.post('add_to_playlist', {'name': playlist, 'uri': _uri}, dest.id)
+        await self.post_batch('add_to_playlist', playlist, [track.uri for track in self.play_queue], dest)
 
     @op_only
     async def cmd_test(self, message, dest, *cmd_args):
@@ -1022,17 +976,17 @@ class Music(discord.Client):
         command, *args = message_content.split(' ')
         command = command.lower()
 
-        handler = getattr(self, f'cmd_{command}', None)
-
-        if not handler:
-            alias = self.config.alias.get(command)
-            if alias:
-                handler = getattr(self, f'cmd_{alias}', None)
+        found = self.commands.lookup(command)
 
-        if handler:
-            await handler(message, message.channel, *args)
+        if found:
+            self.commands.invoked(found)
+            await found.handler(message, message.channel, *args)
         else:
-            await self.safe_send(message.channel, 'いやいやいやいや\nそんな⌘ないけどガイジですか??????????', message.author)
+            res_text = 'いやいやいやいや\nそんな⌘ないけどガイジですか??????????'
+            suggestions = self.commands.suggest(command)
+            if suggestions:
+                res_text += '\n' + ' '.join(f'`{self.config.cmd_prefix}{name}`' for name in suggestions) + ' ?'
+            await self.safe_send(message.channel, res_text, message.author)
 
         if message.channel.id != self.config.text_channel_id:
             await self.safe_delete(message)
@@ -0,0 +1,94 @@
+import json
+
+# the fastest json library installed; none of them is required
+try:
+    import orjson
+    BACKEND = 'orjson'
+    loads = orjson.loads
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    try:
+        import ujson
+        BACKEND = 'ujson'
+        loads = ujson.loads
+        def dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False)
+    except ImportError:
+        BACKEND = 'json'
+        loads = json.loads
+        dumps = json.dumps
+
+# below this the thread hop costs more than it saves
+OFFLOAD_BYTES = 256 * 1024
+
+
+def decode(data):
+    '''
+    parse one ctrl message and split its postback
+
+    postback is `channel id` or `channel id:request id`; the channel id
+    replaces it in the result as an int, None if there is none.
+
+    Returns
+    -------
+    res: dict
+    req_id: str, '' if the message answers no request
+    '''
+    res = loads(data)
+    channel, _, req_id = str(res.get('postback')).partition(':')
+    try:
+        res['postback'] = int(channel)
+    except ValueError:
+        res['postback'] = None
+    return res, req_id
+
+
+class Codec:
+    '''
+    decode ctrl messages, the big ones in an executor
+
+    a queue or playlist of a large library is hundreds of KB and takes
+    milliseconds to parse. the parsers hold the GIL while they run, so a
+    worker thread shaves only a little off the stall; a faster library is
+    what makes the difference. see benchmarks/json_codec.py.
+    '''
+    def __init__(self, loop, offload_bytes=OFFLOAD_BYTES, executor=None):
+        '''
+        Parameters
+        ----------
+        offload_bytes: int, payloads longer than this are parsed off-loop,
+                       0 to parse everything on the loop
+        executor: concurrent.futures.Executor, None for the loop default
+        '''
+        self.loop = loop
+        self.offload_bytes = offload_bytes
+        self.executor = executor
+        self.decoded = 0
+        self.offloaded = 0
+        self.failed = 0
+
+    async def decode(self, data):
+        '''
+        Returns
+        -------
+        res, req_id: as decode(), or (None, '') if data is not json
+        '''
+        self.decoded += 1
+        try:
+            if self.offload_bytes and len(data) > self.offload_bytes:
+                self.offloaded += 1
+                return await self.loop.run_in_executor(self.executor, decode, data)
+            return decode(data)
+        except (ValueError, TypeError, AttributeError):
+            # AttributeError: valid json that is not an object
+            self.failed += 1
+            return None, ''
+
+    def stats(self):
+        return {
+            'backend': BACKEND,
+            'decoded': self.decoded,
+            'offloaded': self.offloaded,
+            'failed': self.failed
+        }
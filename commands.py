@@ -0,0 +1,108 @@
+import bisect
+import difflib
+import logging
+import textwrap
+import time
+
+from metrics import Histogram
+
+# seconds, a lookup is a few dict probes
+LOOKUP_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 1e-3)
+
+
+class Command:
+    '''
+    one `cmd_` handler of Music
+    '''
+    __slots__ = ('name', 'handler', 'doc', 'op_only', 'exact_only', 'usage')
+
+    def __init__(self, name, handler, prefix):
+        self.name = name
+        self.handler = handler
+        self.doc = textwrap.dedent(handler.__doc__ or '').strip().format(prefix=prefix)
+        self.op_only = getattr(handler, 'op_only', False)
+        # operator commands and the ones that drop state never run from a prefix
+        self.exact_only = self.op_only or getattr(handler, 'exact_only', False)
+        # handlers take their arguments as words, the usage line says which
+        self.usage = next((line.strip() for line in self.doc.splitlines()
+                           if line.strip().startswith('usage')), '')
+
+
+class CommandRegistry:
+    '''
+    every command and alias of the client, indexed once
+
+    names and aliases map to a Command. a word that is neither resolves to
+    the command it is the only prefix of, unless that command is
+    exact_only; otherwise suggest() offers close matches. rebuild() swaps
+    in a whole new index, so a lookup never sees a half loaded alias file.
+    '''
+    def __init__(self, client, prefix, alias):
+        self.client = client
+        self.prefix = prefix
+        self.lookups = Histogram(LOOKUP_BUCKETS)
+        self.commands = {}
+        for attr in dir(type(client)):
+            if attr.startswith('cmd_'):
+                name = attr[4:]
+                self.commands[name] = Command(name, getattr(client, attr), prefix)
+        self.invocations = dict.fromkeys(self.commands, 0)
+        self._index = None
+        self.rebuild(alias)
+
+    def rebuild(self, alias):
+        '''
+        Parameters
+        ----------
+        alias: dict, alias to command name
+        '''
+        names = dict(self.commands)
+        for word, name in alias.items():
+            if word in names:
+                continue
+            if name not in self.commands:
+                logging.warning(f'alias {word} is for unknown command {name}')
+                continue
+            names[word] = self.commands[name]
+        self._index = (names, sorted(names))
+
+    @property
+    def names(self):
+        return sorted(self.commands)
+
+    def lookup(self, word):
+        '''
+        Returns
+        -------
+        command: Command, None if word matches none or several, or only
+                 a prefix of an exact_only command
+        '''
+        start = time.perf_counter()
+        names, words = self._index
+        command = names.get(word)
+        if command is None and word:
+            i = bisect.bisect_left(words, word)
+            matches = set()
+            while i < len(words) and words[i].startswith(word):
+                matches.add(names[words[i]])
+                i += 1
+            if len(matches) == 1:
+                command = matches.pop()
+                if command.exact_only:
+                    command = None
+        self.lookups.observe(time.perf_counter() - start)
+        return command
+
+    def suggest(self, word, count=3):
+        '''
+        Returns
+        -------
+        names: list of command names and aliases close to word, closest first
+        '''
+        names, words = self._index
+        matches = [candidate for candidate in words if word and candidate.startswith(word)]
+        matches += difflib.get_close_matches(word, words, count)
+        return list(dict.fromkeys(matches))[:count]
+
+    def invoked(self, command):
+        self.invocations[command.name] += 1
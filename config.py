@@ -1,5 +1,7 @@
+import copy
 import json
 import logging
+import os
 
 
 class Config:
@@ -56,3 +58,62 @@ class Config:
             self.serch_result_count = 5
         if not 1 <= self.serch_result_count <=9 or None:
             self.serch_result_count = 5
+
+        self.buffer_target_ms = int(conf.get('buffer_target_ms') or 100)
+        self.buffer_low_ms = int(conf.get('buffer_low_ms') or 200)
+        self.buffer_high_ms = int(conf.get('buffer_high_ms') or 500)
+        self.audio_thread = conf.get('audio_thread') in (True, 'true', '1')
+        # frames a shared music stream keeps for a session that falls behind
+        self.stream_backlog_ms = int(conf.get('stream_backlog_ms') or 2000)
+
+        # send playlist ops with a uri list; turn off for servers that take one uri per op
+        self.batch_ops = conf.get('batch_ops', True) in (True, 'true', '1')
+        self.max_inflight_ops = int(conf.get('max_inflight_ops') or 8)
+        self.op_timeout = float(conf.get('op_timeout') or 10.0)
+        self.max_pending_requests = int(conf.get('max_pending_requests') or 32)
+
+        # aria websockets reconnect after a random delay below
+        # reconnect_delay * 2^attempt, capped at reconnect_max_delay
+        self.reconnect_delay = float(conf.get('reconnect_delay') or 0.5)
+        self.reconnect_max_delay = float(conf.get('reconnect_max_delay') or 30.0)
+        self.voice_reconnect_cooldown = float(conf.get('voice_reconnect_cooldown') or 30.0)
+        # seconds the voice channel may be empty before leaving it, 0 to stay
+        self.idle_timeout = float(conf.get('idle_timeout', 60.0))
+
+        # search results kept per query, and for how many seconds
+        self.search_cache_size = int(conf.get('search_cache_size') or 64)
+        self.search_cache_ttl = float(conf.get('search_cache_ttl') or 300.0)
+
+        # ctrl messages bigger than this are parsed off the event loop, 0 to never
+        self.decode_offload_kb = int(conf.get('decode_offload_kb', 256))
+
+        # more voice channels to play in, each in its own guild; each entry
+        # has voice_channel_id and text_channel_id, and may override
+        # aria_token, cmd_endpoint and stream_endpoint
+        self.sessions = conf.get('sessions') or []
+        # None lets discord recommend one for our guild count
+        self.shard_count = int(conf.get('shard_count')) if conf.get('shard_count') else None
+        # record what blocks the event loop for this many ms, for the perf command; off when empty
+        self.watchdog_ms = float(conf.get('watchdog_ms')) if conf.get('watchdog_ms') else None
+        # prometheus metrics on http://metrics_host:metrics_port/metrics, off without a port
+        self.metrics_host = conf.get('metrics_host') or '127.0.0.1'
+        self.metrics_port = int(conf.get('metrics_port')) if conf.get('metrics_port') else None
+        # processes run_workers.py plays the voice sessions in, default one per core
+        self.voice_workers = int(conf.get('voice_workers') or 0) or os.cpu_count() or 1
+
+    def session_configs(self):
+        '''
+        Returns
+        -------
+        configs: list of Config, one per voice session, this one first
+        '''
+        configs = [self]
+        for session in self.sessions:
+            config = copy.copy(self)
+            config.voice_channel_id = int(session.get('voice_channel_id'))
+            config.text_channel_id = int(session.get('text_channel_id'))
+            for key in ('aria_token', 'cmd_endpoint', 'stream_endpoint'):
+                if session.get(key):
+                    setattr(config, key, session.get(key))
+            configs.append(config)
+        return configs
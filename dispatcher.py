@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+from metrics import Histogram
+
+
+class Pool:
+    '''
+    a fixed number of workers draining one queue of messages
+    '''
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        # latest_only types: newest message per latest key waiting to be handled
+        self.latest = {}
+
+
+class Dispatcher:
+    '''
+    route ctrl responses to handlers by their type
+
+    each type is registered to a worker pool, so a burst of one kind of
+    message cannot starve the others or pile up unbounded tasks. for
+    latest_only types only the newest message matters: one that arrives
+    while an older one is still waiting replaces it. types that carry the
+    same state share a latest_key, so the newest of any of them wins.
+    '''
+    def __init__(self, loop):
+        self.loop = loop
+        self.pools = {}
+        self.handlers = {}
+        self.received = {}
+        self.coalesced = {}
+        self.timings = {}
+
+    def add_pool(self, name, workers):
+        self.pools[name] = Pool(name, workers)
+
+    def register(self, response_type, handler, pool='default', latest_only=False, latest_key=None):
+        '''
+        handler: coroutine function taking the response, None to ignore the type
+        latest_key: slot shared with other latest_only types, default the type
+        '''
+        slot = (latest_key or response_type) if latest_only else None
+        self.handlers[response_type] = (handler, self.pools[pool], slot)
+        self.received[response_type] = 0
+        self.coalesced[response_type] = 0
+        self.timings[response_type] = Histogram()
+
+    def dispatch(self, res):
+        response_type = res.get('type')
+        if response_type not in self.handlers:
+            logging.warning(f'error: unexpected response type {response_type}')
+            return
+
+        self.received[response_type] += 1
+        handler, pool, slot = self.handlers[response_type]
+        if not handler:
+            return
+
+        if slot:
+            if slot in pool.latest:
+                self.coalesced[response_type] += 1
+            else:
+                pool.queue.put_nowait(slot)
+            pool.latest[slot] = res
+        else:
+            pool.queue.put_nowait(res)
+
+    async def _worker(self, pool):
+        while True:
+            item = await pool.queue.get()
+            if isinstance(item, str):
+                res = pool.latest.pop(item)
+            else:
+                res = item
+            response_type = res.get('type')
+
+            started = self.loop.time()
+            try:
+                await self.handlers[response_type][0](res)
+            except Exception:
+                logging.exception(f'{response_type} handler failed')
+            self.timings[response_type].observe(self.loop.time() - started)
+
+    async def run(self, res_queue):
+        workers = [self.loop.create_task(self._worker(pool))
+                   for pool in self.pools.values() for _ in range(pool.workers)]
+        try:
+            while True:
+                self.dispatch(await res_queue.get())
+        finally:
+            for worker in workers:
+                worker.cancel()
@@ -0,0 +1,142 @@
+import logging
+import struct
+
+try:
+    from nacl._sodium import ffi, lib
+except ImportError:
+    ffi = lib = None
+
+SAMPLES_PER_FRAME = 960
+ZEROBYTES = 32  # crypto_secretbox input padding
+BOXZEROBYTES = 16  # crypto_secretbox output padding, followed by the mac
+NONCE_SIZE = 24
+
+# slot layout, [payload] marks the region handed out by FrameRing.write:
+#   before encryption: | 32 zero bytes | [payload] |
+#   after encryption:  | 4 unused | rtp header | mac | ciphertext | nonce? |
+# the rtp header sits in the output padding, so the packet is sent straight
+# from the slot with no further concatenation.
+PAYLOAD_OFFSET = ZEROBYTES
+HEADER_OFFSET = BOXZEROBYTES - 12
+SLOT_SIZE = 2048
+MAX_PAYLOAD = SLOT_SIZE - PAYLOAD_OFFSET - NONCE_SIZE
+
+_ZERO_PAD = bytes(ZEROBYTES)
+_ZERO_NONCE = bytes(NONCE_SIZE)
+_RTP_HEADER = struct.Struct('>BBHII')
+
+
+class FrameRing:
+    '''
+    preallocated packet slots for opus frames
+
+    write() copies a payload into the next slot and returns a memoryview of
+    it; that is the only copy the payload sees before it is encrypted in
+    place by FrameSender. the ring must have more slots than frames can be
+    alive at once, or a queued frame gets overwritten.
+    '''
+    def __init__(self, slots):
+        self.slots = [bytearray(SLOT_SIZE) for _ in range(slots)]
+        self.views = [memoryview(slot) for slot in self.slots]
+        self._next = 0
+
+    def write(self, payload):
+        size = len(payload)
+        if size > MAX_PAYLOAD:
+            return payload
+        view = self.views[self._next]
+        self._next = (self._next + 1) % len(self.views)
+        view[PAYLOAD_OFFSET:PAYLOAD_OFFSET + size] = payload
+        return view[PAYLOAD_OFFSET:PAYLOAD_OFFSET + size]
+
+
+class FrameSender:
+    '''
+    encrypt ring frames in place and send them on the voice socket
+
+    this mirrors VoiceClient.send_audio_packet, which builds a new header,
+    SecretBox and a few intermediate bytes objects for every packet.
+    anything it cannot handle (no libsodium, unknown mode, a frame that is
+    not a ring slot) goes through send_audio_packet instead.
+    '''
+    MODES = ('xsalsa20_poly1305', 'xsalsa20_poly1305_suffix', 'xsalsa20_poly1305_lite')
+
+    def __init__(self, voice):
+        self.voice = voice
+        self.udp_errors = 0
+        self._nonce = bytearray(NONCE_SIZE)
+        self._nonce_view = memoryview(self._nonce)
+        self._pointers = {}
+        self._key_source = None
+        self._key = None
+        if lib:
+            self._nonce_buffer = ffi.from_buffer(self._nonce)
+            self._nonce_ptr = ffi.cast('unsigned char *', self._nonce_buffer)
+
+    def _pointer(self, slot):
+        '''
+        cdata pointer and memoryview of a slot, built once per slot
+        '''
+        try:
+            return self._pointers[id(slot)]
+        except KeyError:
+            buffer = ffi.from_buffer(slot)
+            entry = (ffi.cast('unsigned char *', buffer), memoryview(slot), buffer, slot)
+            self._pointers[id(slot)] = entry
+            return entry
+
+    def _fast_path(self, frame):
+        return (lib is not None
+                and isinstance(frame, memoryview)
+                and isinstance(frame.obj, bytearray)
+                and len(frame.obj) == SLOT_SIZE
+                and self.voice.mode in self.MODES)
+
+    def send(self, frame):
+        if not self._fast_path(frame):
+            self.voice.send_audio_packet(frame, encode=False)
+            return
+
+        voice = self.voice
+        if voice.secret_key is not self._key_source:
+            self._key_source = voice.secret_key
+            self._key = bytes(voice.secret_key)
+
+        voice.checked_add('sequence', 1, 65535)
+        slot = frame.obj
+        size = len(frame)
+        end = PAYLOAD_OFFSET + size
+
+        nonce = self._nonce
+        nonce[:] = _ZERO_NONCE
+        if voice.mode == 'xsalsa20_poly1305':
+            _RTP_HEADER.pack_into(nonce, 0, 0x80, 0x78, voice.sequence, voice.timestamp, voice.ssrc)
+        elif voice.mode == 'xsalsa20_poly1305_lite':
+            struct.pack_into('>I', nonce, 0, voice._lite_nonce)
+            voice.checked_add('_lite_nonce', 1, 4294967295)
+        else:
+            lib.randombytes(self._nonce_ptr, NONCE_SIZE)
+
+        slot[:ZEROBYTES] = _ZERO_PAD
+        pointer, view, _, _ = self._pointer(slot)
+        if lib.crypto_secretbox(pointer, pointer, end, self._nonce_ptr, self._key) != 0:
+            logging.error('frame encryption failed')
+            return
+        _RTP_HEADER.pack_into(slot, HEADER_OFFSET, 0x80, 0x78, voice.sequence, voice.timestamp, voice.ssrc)
+
+        if voice.mode == 'xsalsa20_poly1305_lite':
+            slot[end:end + 4] = self._nonce_view[:4]
+            end += 4
+        elif voice.mode == 'xsalsa20_poly1305_suffix':
+            slot[end:end + NONCE_SIZE] = nonce
+            end += NONCE_SIZE
+
+        try:
+            voice.socket.sendto(view[HEADER_OFFSET:end], (voice.endpoint_ip, voice.voice_port))
+        except BlockingIOError:
+            logging.warning(f'a packet has been dropped (seq: {voice.sequence})')
+        except OSError:
+            self.udp_errors += 1
+            logging.exception('failed to send a voice packet')
+
+        voice.checked_add('timestamp', SAMPLES_PER_FRAME, 4294967295)
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+import discord
+from opus_loader import load_opus_libs
+from outbox import Outbox
+from presence import PresenceUpdater
+
+
+class Gateway(discord.AutoShardedClient):
+    '''
+    the discord connection shared by every voice session
+
+    discord.py opens as many shards as discord recommends for the number
+    of guilds we are in, unless shard_count is set. a bot can be in one
+    voice channel per guild, so there is one Music session per guild and
+    events go to the session of their guild; direct messages go to the
+    first one. the first session also owns the presence.
+    '''
+    def __init__(self, loop, shard_count=None):
+        super().__init__(loop=loop, shard_count=shard_count)
+        load_opus_libs()
+        self.outbox = Outbox(loop)
+        self.presence = PresenceUpdater(self, loop)
+        self.sessions = []
+        self.by_guild = {}
+        # LoopWatchdog for the perf command, when watchdog_ms is set
+        self.watchdog = None
+
+    def add(self, music):
+        self.sessions.append(music)
+
+    @property
+    def primary(self):
+        return self.sessions[0] if self.sessions else None
+
+    def session_of(self, guild):
+        if guild is None:
+            return self.primary
+        return self.by_guild.get(guild.id)
+
+    async def on_ready(self):
+        logging.info(f'connected to discord with {self.shard_count} shards')
+        self.by_guild = {}
+        for music in self.sessions:
+            channel = self.get_channel(music.config.voice_channel_id)
+            if channel is None:
+                logging.error(f'voice channel {music.config.voice_channel_id} not found')
+                continue
+            if channel.guild.id in self.by_guild:
+                logging.error(f'voice channel {channel.id} skipped, one session per guild')
+                continue
+            self.by_guild[channel.guild.id] = music
+
+        results = await asyncio.gather(*[music.on_ready() for music in self.by_guild.values()],
+                                       return_exceptions=True)
+        for music, result in zip(self.by_guild.values(), results):
+            if isinstance(result, Exception):
+                logging.error(f'session {music.config.voice_channel_id} failed to start: {result!r}')
+
+    async def on_message(self, message):
+        music = self.session_of(message.guild)
+        if music:
+            await music.on_message(message)
+
+    async def on_voice_state_update(self, member, before, after):
+        music = self.session_of(member.guild)
+        if music:
+            await music.on_voice_state_update(member, before, after)
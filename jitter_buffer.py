@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from collections import deque
+
+from frames import FrameRing
+
+FRAME_MS = 20  # opus frame duration
+
+
+class JitterBuffer:
+    '''
+    bounded frame buffer between the music websocket and the player
+
+    target_ms: depth to pre-roll before playback starts, after an underrun
+               and after a track change
+    low_ms:    a paused writer is resumed once the depth drains to this
+    high_ms:   put() pauses the writer (and so the websocket reader) here
+
+    put_nowait() never blocks; past twice the high watermark it drops the
+    oldest frame and counts an overrun. frames are copied into ring slots
+    on the way in, so the player can encrypt them in place.
+    get()/get_nowait()/qsize()/empty() behave like asyncio.Queue so the
+    player does not care which one it is fed from; ready() waits for a
+    frame without taking it, for FrameScheduler.
+    '''
+    def __init__(self, target_ms=100, low_ms=200, high_ms=500, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.target = max(1, target_ms // FRAME_MS)
+        self.high = max(self.target, high_ms // FRAME_MS)
+        self.low = min(max(self.target, low_ms // FRAME_MS), self.high)
+        self.capacity = self.high * 2
+        # one slot for the frame being sent, one spare
+        self.ring = FrameRing(self.capacity + 2)
+
+        self.underruns = 0
+        self.overruns = 0
+        self.pauses = 0
+
+        self._frames = deque()
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._priming = True
+        self._playing = False
+        self._preroll_deadline = 0
+
+    @property
+    def depth_ms(self):
+        return len(self._frames) * FRAME_MS
+
+    def qsize(self):
+        return len(self._frames)
+
+    def empty(self):
+        return not self._frames
+
+    def put_nowait(self, frame):
+        if not self._frames:
+            # give a short tail twice the pre-roll time to fill the target
+            self._preroll_deadline = self.loop.time() + self.target * FRAME_MS / 500
+        elif len(self._frames) >= self.capacity:
+            self._frames.popleft()
+            self.overruns += 1
+        self._frames.append(self.ring.write(frame))
+        self._readable.set()
+
+    async def put(self, frame):
+        if len(self._frames) >= self.high:
+            self.pauses += 1
+            self._writable.clear()
+            await self._writable.wait()
+        self.put_nowait(frame)
+
+    def _primed(self):
+        if self._priming and (len(self._frames) >= self.target or
+                              self._frames and self.loop.time() >= self._preroll_deadline):
+            self._priming = False
+        return not self._priming and bool(self._frames)
+
+    def get_nowait(self):
+        if not self._primed():
+            if self._playing:
+                self.underruns += 1
+                logging.debug(f'jitter buffer underrun ({self.underruns})')
+                self._playing = False
+                self._priming = True
+            raise asyncio.QueueEmpty
+
+        frame = self._frames.popleft()
+        self._playing = True
+        if len(self._frames) <= self.low:
+            self._writable.set()
+        return frame
+
+    async def get(self):
+        while True:
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            await self.ready()
+
+    async def ready(self):
+        '''
+        until get_nowait() has a frame to give, without taking it
+        '''
+        while not self._primed():
+            self._readable.clear()
+            if not self._frames:
+                await self._readable.wait()
+                continue
+
+            timeout = self._preroll_deadline - self.loop.time()
+            if timeout <= 0:
+                self._priming = False
+                continue
+            try:
+                await asyncio.wait_for(self._readable.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def rebuffer(self):
+        '''
+        pre-roll again before the next frame, e.g. after a track change
+        '''
+        self._priming = True
+        self._playing = False
+
+    def flush(self):
+        self._frames.clear()
+        self.rebuffer()
+        self._writable.set()
+
+    def stats(self):
+        return {
+            'depth_ms': self.depth_ms,
+            'underruns': self.underruns,
+            'overruns': self.overruns,
+            'pauses': self.pauses
+        }
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+
+def _launched_at():
+    '''
+    monotonic time the process was started, or now if /proc is unavailable
+    '''
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return time.monotonic() - (uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.monotonic()
+
+LAUNCHED_AT = _launched_at()
+
+
+class Lifecycle:
+    '''
+    startup stages shared by the discord client and the aria websockets
+
+    key:       ctrl websocket said hello and handed out the stream key
+    discord:   bot is connected to discord
+    listening: someone is in the voice channel to hear the stream
+    stream:    music websocket is connected
+    audio:     first packet went out to discord
+
+    components await the stages they depend on instead of polling, and the
+    time from process launch to each stage is logged once.
+    '''
+    STAGES = ('key', 'discord', 'listening', 'stream', 'audio')
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.key = None
+        self.timings = {}
+        self._events = {stage: asyncio.Event() for stage in self.STAGES}
+        self._cleared = {stage: asyncio.Event() for stage in self.STAGES}
+        for event in self._cleared.values():
+            event.set()
+        self._thread = threading.get_ident()
+
+    @property
+    def state(self):
+        '''
+        furthest stage reached
+        '''
+        reached = [stage for stage in self.STAGES if self._events[stage].is_set()]
+        return reached[-1] if reached else 'starting'
+
+    def is_ready(self, stage):
+        return self._events[stage].is_set()
+
+    def mark(self, stage):
+        if self._events[stage].is_set():
+            return
+        first = stage not in self.timings
+        if first:
+            self.timings[stage] = time.monotonic() - LAUNCHED_AT
+        if threading.get_ident() != self._thread:
+            # marked from the audio thread
+            self.loop.call_soon_threadsafe(self._set, stage, first)
+        else:
+            self._set(stage, first)
+
+    def _set(self, stage, first):
+        self._events[stage].set()
+        self._cleared[stage].clear()
+        if first:
+            logging.info(f'{stage} ready {self.timings[stage]:.2f}s after launch')
+            if stage == 'audio':
+                logging.info('startup: ' + ', '.join(f'{s} {t:.2f}s' for s, t in self.timings.items()))
+
+    def clear(self, stage):
+        self._events[stage].clear()
+        self._cleared[stage].set()
+
+    async def wait(self, *stages):
+        for stage in stages:
+            await self._events[stage].wait()
+
+    async def wait_cleared(self, stage):
+        await self._cleared[stage].wait()
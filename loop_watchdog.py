@@ -0,0 +1,214 @@
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from metrics import LoopMonitor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# lines of stack kept per stall
+STACK_LIMIT = 16
+RECENT = 50
+# where the event loop calls into a callback or task step
+LOOP_CALL = os.path.join('asyncio', 'events.py')
+
+
+def _name(frame):
+    '''
+    Class.method, or module.function, of a frame
+    '''
+    code = frame.f_code
+    owner = frame.f_locals.get('self')
+    if owner is not None:
+        return f'{type(owner).__name__}.{code.co_name}'
+    return f'{os.path.splitext(os.path.basename(code.co_filename))[0]}.{code.co_name}'
+
+def _ours(path):
+    # the script that was run has a path relative to where it was started
+    return path.startswith(ROOT) or not os.path.isabs(path)
+
+def _step(entries):
+    '''
+    the part of a stack below the event loop, the callback or task step
+    it is running
+    '''
+    calls = [n for n, entry in enumerate(entries) if entry.filename.endswith(LOOP_CALL)]
+    return entries[calls[-1] + 1:] if calls else entries
+
+def stack_of(frame):
+    '''
+    formatted stack of the step the loop is running, from our outermost
+    function in
+    '''
+    entries = _step(traceback.extract_stack(frame))
+    first = next((n for n, entry in enumerate(entries) if _ours(entry.filename)), 0)
+    return traceback.format_list(entries[first:])[-STACK_LIMIT:]
+
+def handler_of(frame):
+    '''
+    the outermost and innermost of our own functions on the stack, e.g.
+    `Gateway.on_message > render.split`; a step of a task starts at its
+    coroutine, so the outermost one is what the loop was running
+    '''
+    names = []
+    while frame is not None and not frame.f_code.co_filename.endswith(LOOP_CALL):
+        if _ours(frame.f_code.co_filename):
+            names.append(_name(frame))
+        frame = frame.f_back
+    if not names:
+        return 'library code'
+    outer, inner = names[-1], names[0]
+    return outer if outer == inner else f'{outer} > {inner}'
+
+
+class Stall:
+    __slots__ = ('loop', 'handler', 'duration', 'stack', 'at')
+
+    def __init__(self, loop, handler, duration, stack, at):
+        self.loop = loop
+        self.handler = handler
+        self.duration = duration
+        self.stack = stack
+        self.at = at
+
+
+class WatchedLoop:
+    '''
+    heartbeat of one event loop
+
+    a callback re-arms itself every `interval` seconds on the loop; how
+    late it runs is the scheduling lag, observed on the loop's monitor.
+    the watchdog thread reads `beat` to notice a loop that stopped beating.
+    '''
+    def __init__(self, name, monitor, interval):
+        self.name = name
+        self.loop = monitor.loop
+        self.monitor = monitor
+        self.interval = interval
+        self.thread = None
+        self.beat = None
+        # (beat, handler, stack) the watchdog sampled during a stall
+        self.sample = None
+
+
+class LoopWatchdog:
+    '''
+    find what blocks the event loops
+
+    a daemon thread checks every loop's heartbeat; once one is `threshold`
+    seconds overdue it takes the loop thread's stack from
+    sys._current_frames(). when the loop beats again the stall is recorded
+    with how long it took, and summed up per handler for `.perf`. a stall
+    the thread could not sample, because the loop held the GIL all along,
+    is still recorded, without a stack.
+    '''
+    def __init__(self, threshold=0.05, interval=None):
+        self.threshold = threshold
+        # a stall shows up as lag between its length and its length less
+        # one interval, so beat well inside the threshold
+        self.interval = interval or threshold / 2
+        self.loops = []
+        self.recent = deque(maxlen=RECENT)
+        # handler: [count, total seconds, worst Stall]
+        self.handlers = {}
+        self.stalls = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def watch(self, name, loop, monitor=None):
+        '''
+        beat on `loop`, feeding the lag into `monitor` when the loop has one
+        for the metrics endpoint
+
+        Returns
+        -------
+        monitor: LoopMonitor
+        '''
+        watched = WatchedLoop(name, monitor or LoopMonitor(loop), self.interval)
+        self.loops.append(watched)
+        loop.call_soon_threadsafe(self._beat, watched, None)
+        return watched.monitor
+
+    def _beat(self, watched, expected):
+        now = time.monotonic()
+        watched.thread = threading.get_ident()
+        if expected is not None:
+            lag = max(0.0, now - expected)
+            watched.monitor.observe(lag)
+            if lag >= self.threshold:
+                sample = watched.sample
+                if sample and sample[0] == watched.beat:
+                    self._record(Stall(watched.name, sample[1], lag, sample[2], time.time()))
+                else:
+                    self._record(Stall(watched.name, 'not sampled', lag, None, time.time()))
+        watched.sample = None
+        watched.beat = now
+        watched.loop.call_later(self.interval, self._beat, watched, now + self.interval)
+
+    def _record(self, stall):
+        with self._lock:
+            self.recent.append(stall)
+            self.stalls += 1
+            entry = self.handlers.get(stall.handler)
+            first = entry is None
+            if first:
+                entry = self.handlers[stall.handler] = [0, 0.0, stall]
+            entry[0] += 1
+            entry[1] += stall.duration
+            if stall.duration >= entry[2].duration:
+                entry[2] = stall
+        logging.warning(f'{stall.loop} loop blocked {stall.duration * 1000:.0f}ms in {stall.handler}')
+        if first and stall.stack:
+            logging.warning('blocked at:\n' + ''.join(stall.stack))
+
+    def _check(self):
+        now = time.monotonic()
+        frames = None
+        for watched in self.loops:
+            beat = watched.beat
+            if beat is None or watched.sample is not None:
+                continue
+            if now - beat - self.interval < self.threshold:
+                continue
+            if frames is None:
+                frames = sys._current_frames()
+            frame = frames.get(watched.thread)
+            if frame is None:
+                continue
+            watched.sample = (beat, handler_of(frame), stack_of(frame))
+
+    def _run(self):
+        while not self._stopped.wait(self.threshold / 2):
+            try:
+                self._check()
+            except Exception:
+                logging.exception('loop watchdog check failed')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+
+    def top(self, count=10):
+        '''
+        Returns
+        -------
+        handlers: list of (handler, count, total seconds, worst Stall), most
+                  time blocked first
+        '''
+        with self._lock:
+            entries = [(handler, *entry) for handler, entry in self.handlers.items()]
+        entries.sort(key=lambda entry: entry[2], reverse=True)
+        return entries[:count]
+
+    def stats(self):
+        return {
+            'lag': {watched.name: str(watched.monitor.lag) for watched in self.loops},
+            'stalls': self.stalls
+        }
@@ -0,0 +1,204 @@
+import asyncio
+import bisect
+import logging
+
+from aiohttp import web
+
+# seconds, roughly log spaced from 1ms to 10s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds, a frame is 20ms so anything past 10ms is audible
+LAG_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 1.0)
+
+
+class Histogram:
+    '''
+    fixed bucket histogram, cheap enough to observe on every op
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''
+        upper bound of the bucket holding the q-quantile
+        '''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def __str__(self):
+        if not self.count:
+            return 'no samples'
+        return (f'n={self.count} avg={self.sum / self.count * 1000:.1f}ms '
+                f'p50<={self.quantile(0.5) * 1000:g}ms '
+                f'p90<={self.quantile(0.9) * 1000:g}ms '
+                f'p99<={self.quantile(0.99) * 1000:g}ms')
+
+
+class Counter:
+    '''
+    a count that only goes up
+
+    inc() is a plain attribute add, safe as long as one thread writes it.
+    a counter kept elsewhere, like Player.frames_sent, is bound with read
+    instead and costs nothing until it is scraped.
+    '''
+    __slots__ = ('value', 'read')
+    kind = 'counter'
+
+    def __init__(self, read=None):
+        self.value = 0
+        self.read = read
+
+    def inc(self, n=1):
+        self.value += n
+
+    def get(self):
+        return self.read() if self.read else self.value
+
+
+class Gauge(Counter):
+    '''
+    a value that goes up and down
+    '''
+    __slots__ = ()
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class Registry:
+    '''
+    named metrics, rendered in the prometheus text format
+
+    metrics are created once while wiring and kept by whoever updates
+    them; the same name with other labels is another series of the family.
+    '''
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.families = {}
+
+    def _add(self, name, help, metric, labels):
+        name = self.prefix + name
+        kind = 'histogram' if isinstance(metric, Histogram) else metric.kind
+        family = self.families.setdefault(name, (kind, help, []))
+        if family[0] != kind:
+            raise ValueError(f'{name} is a {family[0]}, not a {kind}')
+        family[2].append((labels, metric))
+        return metric
+
+    def counter(self, name, help, read=None, **labels):
+        return self._add(name, help, Counter(read), labels)
+
+    def gauge(self, name, help, read=None, **labels):
+        return self._add(name, help, Gauge(read), labels)
+
+    def histogram(self, name, help, histogram=None, **labels):
+        '''
+        histogram: an existing Histogram to expose, or None for a new one
+        '''
+        return self._add(name, help, histogram if histogram is not None else Histogram(), labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, help, series) in self.families.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in series:
+                if kind != 'histogram':
+                    lines.append(f'{name}{_labels(labels)} {metric.get()}')
+                    continue
+                seen = 0
+                for bound, n in zip(metric.buckets, metric.counts):
+                    seen += n
+                    lines.append(f'{name}_bucket{_labels(labels, le=bound)} {seen}')
+                lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {metric.count}')
+                lines.append(f'{name}_sum{_labels(labels)} {metric.sum}')
+                lines.append(f'{name}_count{_labels(labels)} {metric.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class LoopMonitor:
+    '''
+    event loop lag and task count
+
+    run() sleeps `interval` at a time; how much later than asked it wakes
+    up is the time the loop spent on other callbacks before getting to it.
+    when the loop watchdog is on, its heartbeat feeds observe() instead and
+    run() is not started, so the loop has one heartbeat and one lag.
+    '''
+    def __init__(self, loop, interval=0.25):
+        self.loop = loop
+        self.interval = interval
+        self.lag = Histogram(LAG_BUCKETS)
+        self.last = 0.0
+
+    def tasks(self):
+        return len(asyncio.all_tasks(self.loop))
+
+    async def run(self):
+        while True:
+            started = self.loop.time()
+            await asyncio.sleep(self.interval)
+            self.observe(max(0.0, self.loop.time() - started - self.interval))
+
+    def observe(self, lag):
+        self.last = lag
+        self.lag.observe(lag)
+
+    def stats(self):
+        return {
+            'lag': str(self.lag),
+            'tasks': self.tasks()
+        }
+
+
+class MetricsServer:
+    '''
+    serve a registry on http://host:port/metrics
+    '''
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle(self, request):
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logging.info(f'metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
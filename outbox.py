@@ -0,0 +1,210 @@
+import datetime
+import logging
+from collections import deque
+
+import discord
+
+MESSAGE_LIMIT = 2000
+BULK_LIMIT = 100
+# discord refuses to bulk delete messages older than 14 days
+BULK_MAX_AGE = datetime.timedelta(days=13, hours=23)
+
+
+class RateLimitCounter(logging.Handler):
+    '''
+    count the 429s discord.py logs on the discord.http logger
+    '''
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+        self.buckets = {}
+
+    def emit(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith('We are being rate limited'):
+            self.count += 1
+            bucket = record.args[1] if len(record.args) > 1 else None
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+
+class Action:
+    __slots__ = ('target', 'payload', 'merge', 'future')
+
+    def __init__(self, target, payload, merge, future):
+        self.target = target
+        self.payload = payload
+        self.merge = merge
+        self.future = future
+
+
+class Outbox:
+    '''
+    one queue of discord REST calls per channel and route
+
+    discord rate limits sending, deleting and reacting per channel, so each
+    (channel, route) pair is drained by its own task: a 429 stalls that
+    lane only. work that piles up while a call is in flight is folded:
+    consecutive sends become one message while they fit in MESSAGE_LIMIT,
+    and deletes become one bulk delete when we may manage messages.
+    '''
+    def __init__(self, loop):
+        self.loop = loop
+        self.lanes = {}
+        self.sent = 0
+        self.merged = 0
+        self.deleted = 0
+        self.bulk_deletes = 0
+        self.rate_limits = RateLimitCounter()
+        logging.getLogger('discord.http').addHandler(self.rate_limits)
+
+    def _queue(self, channel, route, target, payload=None, merge=False):
+        future = self.loop.create_future()
+        key = (channel.id, route)
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = deque()
+            self.loop.create_task(self._drain(key, lane))
+        lane.append(Action(target, payload, merge, future))
+        return future
+
+    async def _drain(self, key, lane):
+        route = key[1]
+        try:
+            while lane:
+                if route == 'send':
+                    await self._send(lane)
+                elif route == 'delete':
+                    await self._delete(lane)
+                else:
+                    await self._react(lane.popleft())
+        finally:
+            # whatever stopped the lane, nobody keeps waiting on it
+            while lane:
+                future = lane.popleft().future
+                if not future.done():
+                    future.set_result(None)
+            del self.lanes[key]
+
+    def send(self, dest, content, merge=True):
+        '''
+        Parameters
+        ----------
+        merge: bool, False if the message will be edited, reacted to or
+               deleted on its own
+
+        Returns
+        -------
+        future: resolves with the message, None if sending failed
+        '''
+        return self._queue(dest, 'send', dest, content, merge)
+
+    def delete(self, message, delay=0):
+        '''
+        Returns
+        -------
+        future: resolves once the message is deleted or could not be
+        '''
+        if delay:
+            future = self.loop.create_future()
+            def _later():
+                deleted = self._queue(message.channel, 'delete', message)
+                deleted.add_done_callback(lambda _: future.done() or future.set_result(None))
+            self.loop.call_later(delay, _later)
+            return future
+        return self._queue(message.channel, 'delete', message)
+
+    def react(self, message, emojis):
+        '''
+        add reactions in order; cancel the future to stop adding them
+
+        Returns
+        -------
+        future: resolves once all are added
+        '''
+        return self._queue(message.channel, 'react', message, list(emojis))
+
+    async def _send(self, lane):
+        actions = [lane.popleft()]
+        content = actions[0].payload
+        while actions[0].merge and lane and lane[0].merge:
+            merged = f'{content}\n{lane[0].payload}'
+            if len(merged) > MESSAGE_LIMIT:
+                break
+            content = merged
+            actions.append(lane.popleft())
+
+        message = None
+        try:
+            message = await actions[0].target.send(content)
+        except discord.Forbidden:
+            logging.error('You do not have the proper permissions to send the message.')
+        except discord.NotFound:
+            logging.error('dest channel is not found')
+        except discord.HTTPException:
+            logging.error('Sending the message failed.')
+        except Exception:
+            # discord.py passes connection errors and timeouts through
+            logging.exception('Sending the message failed.')
+        finally:
+            for action in actions:
+                if not action.future.done():
+                    action.future.set_result(message)
+        self.sent += 1
+        self.merged += len(actions) - 1
+
+    async def _delete(self, lane):
+        actions = [lane.popleft()]
+        channel = actions[0].target.channel
+        bulk = (isinstance(channel, discord.TextChannel)
+                and channel.permissions_for(channel.guild.me).manage_messages)
+        oldest = datetime.datetime.utcnow() - BULK_MAX_AGE
+        if bulk and actions[0].target.created_at > oldest:
+            while lane and len(actions) < BULK_LIMIT and lane[0].target.created_at > oldest:
+                actions.append(lane.popleft())
+
+        # merged sends share one message
+        messages = list({action.target.id: action.target for action in actions}.values())
+        try:
+            if len(messages) > 1:
+                await channel.delete_messages(messages)
+                self.bulk_deletes += 1
+            else:
+                await messages[0].delete()
+        except discord.Forbidden:
+            logging.error('cannot delete message: no permission')
+        except discord.NotFound:
+            logging.error('cannot delete message: message not found')
+        except discord.HTTPException:
+            logging.error('cannot delete message')
+        except Exception:
+            logging.exception('cannot delete message')
+        finally:
+            for action in actions:
+                if not action.future.done():
+                    action.future.set_result(None)
+        self.deleted += len(messages)
+
+    async def _react(self, action):
+        try:
+            for emoji in action.payload:
+                if action.future.done():
+                    # cancelled
+                    return
+                try:
+                    await action.target.add_reaction(emoji)
+                except discord.HTTPException:
+                    logging.error(f'cannot add reaction {emoji}')
+                except Exception:
+                    logging.exception(f'cannot add reaction {emoji}')
+        finally:
+            if not action.future.done():
+                action.future.set_result(None)
+
+    def stats(self):
+        return {
+            'depth': sum(len(lane) for lane in self.lanes.values()),
+            'sent': self.sent,
+            'merged': self.merged,
+            'deleted': self.deleted,
+            'bulk_deletes': self.bulk_deletes,
+            'rate_limited': self.rate_limits.count
+        }
@@ -0,0 +1,52 @@
+from track import Track
+
+
+class PlayQueue:
+    '''
+    local copy of the aria play queue
+
+    aria sends the whole queue on every change; update() keeps the Track
+    of every uri still queued and only builds new ones, and bumps version
+    only if the order of uris changed. the rendered view is cached per
+    version.
+    '''
+    def __init__(self):
+        self.tracks = []
+        self.version = 0
+        self._view = None
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    def track_at(self, index):
+        '''
+        Returns
+        -------
+        track: Track at the 0-based index, None if out of range
+        '''
+        if 0 <= index < len(self.tracks):
+            return self.tracks[index]
+        return None
+
+    def update(self, entries):
+        entries = entries or []
+        if len(entries) == len(self.tracks) and \
+                all(entry.get('uri') == track.uri for entry, track in zip(entries, self.tracks)):
+            return
+        known = {track.uri: track for track in self.tracks}
+        self.tracks = [known.get(entry.get('uri')) or Track.from_entry(entry) for entry in entries]
+        self.version += 1
+
+    async def view(self, key, render):
+        '''
+        await render(self), reusing the last result while neither the queue
+        nor key changed
+
+        key: hashable state the rendering depends on besides the queue
+        '''
+        if self._view is None or self._view[0] != (self.version, key):
+            self._view = ((self.version, key), await render(self))
+        return self._view[1]
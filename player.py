@@ -0,0 +1,228 @@
+import asyncio
+import logging
+
+from frames import FrameSender
+
+FRAME_LENGTH = 0.02  # seconds of audio in one opus frame
+MAX_LATENESS = 0.1  # resync the clock when further behind than this
+
+
+class Player:
+    '''
+    send opus frames to discord on the 20ms frame clock
+
+    frames are paced against a monotonic deadline instead of being sent as
+    fast as they arrive. the deadline advances by FRAME_LENGTH per frame so
+    sleep jitter does not accumulate; if the loop falls further behind than
+    MAX_LATENESS the clock is resynced instead of bursting to catch up.
+    '''
+    def __init__(self, source, loop, lifecycle=None, scheduler=None):
+        '''
+        Parameters
+        ----------
+        scheduler: FrameScheduler to pace this player with others, None to
+                   run its own clock
+        '''
+        self.source = source
+        self.loop = loop
+        self.lifecycle = lifecycle
+        self.scheduler = scheduler
+        self.sender = None
+        self.frames_sent = 0
+        self.frames_late = 0
+        self.frames_dropped = 0
+        self._reported = (0, 0)
+        self._task = None
+        self._playing = False
+
+    # the player may run on the audio thread, so these hop onto its loop
+
+    def start(self):
+        self.loop.call_soon_threadsafe(self._start)
+
+    def _start(self):
+        if self.scheduler:
+            self.scheduler.add(self)
+        elif not self._task or self._task.done():
+            self._task = self.loop.create_task(self.run())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        if self.scheduler:
+            self.scheduler.remove(self)
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def flush(self):
+        self.loop.call_soon_threadsafe(self.source.flush)
+
+    def rebuffer(self):
+        self.loop.call_soon_threadsafe(self.source.rebuffer)
+
+    @property
+    def voice(self):
+        return self.sender.voice if self.sender else None
+
+    @voice.setter
+    def voice(self, voice):
+        # one assignment, so the audio thread never sees a half-swapped voice
+        self.sender = FrameSender(voice) if voice else None
+
+    def send(self, packet):
+        sender = self.sender
+        if sender and sender.voice.is_connected():
+            sender.send(packet)
+            if not self.frames_sent and self.lifecycle:
+                self.lifecycle.mark('audio')
+            self.frames_sent += 1
+        else:
+            self.frames_dropped += 1
+
+    async def run(self):
+        while True:
+            # sleep until the stream has something for us
+            packet = await self.source.get()
+            deadline = self.loop.time()
+            while True:
+                self.send(packet)
+                deadline += FRAME_LENGTH
+                delay = deadline - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -MAX_LATENESS:
+                    self.frames_late += 1
+                    logging.warning(f'player is {-delay*1000:.0f}ms behind, resync')
+                    deadline = self.loop.time()
+                elif delay < 0:
+                    self.frames_late += 1
+
+                try:
+                    packet = self.source.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+            self.report()
+
+    def tick(self):
+        '''
+        send the next frame if the stream has one, for FrameScheduler
+
+        Returns
+        -------
+        sent: bool
+        '''
+        try:
+            packet = self.source.get_nowait()
+        except asyncio.QueueEmpty:
+            if self._playing:
+                self._playing = False
+                self.report()
+            return False
+        self._playing = True
+        self.send(packet)
+        return True
+
+    def report(self):
+        '''
+        log late/dropped frames once the stream goes idle
+        '''
+        late = self.frames_late - self._reported[0]
+        dropped = self.frames_dropped - self._reported[1]
+        if late or dropped:
+            logging.info(f'player: {late} late, {dropped} dropped frames, buffer: {self.source.stats()}')
+        self._reported = (self.frames_late, self.frames_dropped)
+
+    def stats(self):
+        return {
+            'sent': self.frames_sent,
+            'late': self.frames_late,
+            'dropped': self.frames_dropped,
+            **self.source.stats()
+        }
+
+
+class FrameScheduler:
+    '''
+    one 20ms frame clock for the players of many voice sessions
+
+    with a task per player every session sleeps and wakes on its own, 50
+    times a second each, and a session catching up after a stall sends its
+    frames back to back while the others wait. the scheduler wakes once per
+    frame and sends exactly one frame of every session that has one, in
+    the same order each round so every session keeps a steady interval. a
+    late round is late for every session in it, and the clock is resynced
+    like Player does. once a round has nothing to send the clock stops
+    until a buffer has a frame again.
+    '''
+    def __init__(self, loop):
+        self.loop = loop
+        self.players = []
+        self.rounds = 0
+        self.late = 0
+        self.idles = 0
+        self._task = None
+        # made in run(), on the loop the scheduler runs on
+        self._changed = None
+
+    def add(self, player):
+        if player not in self.players:
+            self.players.append(player)
+            if self._changed:
+                self._changed.set()
+        if not self._task or self._task.done():
+            self._task = self.loop.create_task(self.run())
+
+    def remove(self, player):
+        if player in self.players:
+            self.players.remove(player)
+            if self._changed:
+                self._changed.set()
+
+    async def _idle(self):
+        '''
+        until a player has a frame or the players change
+        '''
+        self.idles += 1
+        self._changed.clear()
+        waits = [self.loop.create_task(player.source.ready()) for player in self.players]
+        waits.append(self.loop.create_task(self._changed.wait()))
+        try:
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for wait in waits:
+                wait.cancel()
+
+    async def run(self):
+        self._changed = asyncio.Event()
+        deadline = self.loop.time()
+        while self.players:
+            playing = [player for player in self.players if player.tick()]
+            self.rounds += 1
+            if not playing:
+                await self._idle()
+                deadline = self.loop.time()
+                continue
+
+            deadline += FRAME_LENGTH
+            delay = deadline - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self.late += 1
+            for player in playing:
+                player.frames_late += 1
+            if delay < -MAX_LATENESS:
+                logging.warning(f'frame clock is {-delay*1000:.0f}ms behind, resync')
+                deadline = self.loop.time()
+            # let the streams fill the buffers
+            await asyncio.sleep(0)
+
+    def stats(self):
+        return {
+            'players': len(self.players),
+            'rounds': self.rounds,
+            'late': self.late,
+            'idles': self.idles
+        }
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from collections import deque
+
+import discord
+
+# discord drops presence updates past about 5 per minute per gateway
+PRESENCE_RATE = 5
+PRESENCE_PER = 60.0
+
+
+class PresenceUpdater:
+    '''
+    debounced, rate limited change_presence
+
+    update() only records the wanted text; run() waits for a burst of
+    updates to settle (at most three debounce periods), then sends the
+    newest one if it differs from what discord already shows and the
+    per-minute budget allows.
+    '''
+    def __init__(self, client, loop, debounce=2.0, rate=PRESENCE_RATE, per=PRESENCE_PER):
+        self.client = client
+        self.loop = loop
+        self.debounce = debounce
+        self.rate = rate
+        self.per = per
+        self.desired = None
+        self.current = None
+        self.sent = 0
+        self.suppressed = 0
+        self._history = deque()
+        self._wakeup = asyncio.Event()
+
+    def update(self, text):
+        if self.desired != self.current:
+            # the one still waiting will never be shown
+            self.suppressed += 1
+        elif text == self.current:
+            self.suppressed += 1
+            return
+        self.desired = text
+        self._wakeup.set()
+
+    async def _wait_for_budget(self):
+        while True:
+            now = self.loop.time()
+            while self._history and now - self._history[0] >= self.per:
+                self._history.popleft()
+            if len(self._history) < self.rate:
+                return
+            await asyncio.sleep(self._history[0] + self.per - now)
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            # wait until updates stop for a debounce period, but not forever
+            give_up = self.loop.time() + self.debounce * 3
+            while self._wakeup.is_set() and self.loop.time() < give_up:
+                self._wakeup.clear()
+                await asyncio.sleep(self.debounce)
+            await self._wait_for_budget()
+            self._wakeup.clear()
+
+            text = self.desired
+            if text == self.current:
+                continue
+            try:
+                await self.client.change_presence(activity=discord.Game(name=text))
+            except (discord.HTTPException, discord.ConnectionClosed):
+                logging.exception('failed to change presence')
+                continue
+            self.current = text
+            self._history.append(self.loop.time())
+            self.sent += 1
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'suppressed': self.suppressed
+        }
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import random
+
+import aiohttp
+
+from metrics import Histogram
+
+# a dropped or refused link, as opposed to a bug in the component
+LINK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+class Backoff:
+    '''
+    exponential backoff with full jitter, so reconnects spread out instead
+    of hitting the server in lockstep
+    '''
+    def __init__(self, base=0.5, cap=30.0):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    def next(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempts))
+        self.attempts += 1
+        return delay
+
+    def reset(self):
+        self.attempts = 0
+
+
+class Reconnector:
+    '''
+    keep one aria websocket connected
+
+    connect is a coroutine function that opens the link and returns or
+    raises when it drops, or returns True when it closed the link on
+    purpose, which is not a drop. it calls up() once the link is usable.
+    that resets the backoff and records the time to recover, from the drop
+    to up(). errors that are not LINK_ERRORS still reach the supervisor.
+
+    recovery: an existing Histogram to record into, or None for a new one
+    '''
+    def __init__(self, name, connect, loop, base=0.5, cap=30.0, recovery=None):
+        self.name = name
+        self.connect = connect
+        self.loop = loop
+        self.backoff = Backoff(base, cap)
+        self.drops = 0
+        self.recovery = recovery if recovery is not None else Histogram()
+        self._down_since = None
+
+    def up(self):
+        if self._down_since is not None:
+            elapsed = self.loop.time() - self._down_since
+            self.recovery.observe(elapsed)
+            logging.info(f'{self.name} recovered in {elapsed:.2f}s')
+            self._down_since = None
+        self.backoff.reset()
+
+    async def run(self):
+        while True:
+            try:
+                if await self.connect():
+                    continue
+                logging.warning(f'{self.name} ws closed')
+            except LINK_ERRORS as e:
+                logging.warning(f'{self.name} ws failed: {e!r}')
+
+            if self._down_since is None:
+                self.drops += 1
+                self._down_since = self.loop.time()
+            delay = self.backoff.next()
+            logging.info(f'reconnecting {self.name} in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            'drops': self.drops,
+            'down': self._down_since is not None,
+            'recovery': str(self.recovery)
+        }
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+
+from outbox import MESSAGE_LIMIT
+
+FENCE = '```'
+
+
+class FragmentCache:
+    '''
+    rendered text per Track
+
+    a Track is immutable and hashable, so the text built from it never goes
+    stale; the same track shows up in the queue, search results and now
+    playing again and again. past `size` tracks the least recently used
+    one is evicted.
+    '''
+    def __init__(self, build, size=4096):
+        '''
+        Parameters
+        ----------
+        build: function from Track to str
+        '''
+        self.build = build
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._fragments = OrderedDict()
+
+    def get(self, track):
+        fragment = self._fragments.get(track)
+        if fragment is not None:
+            self._fragments.move_to_end(track)
+            self.hits += 1
+            return fragment
+        self.misses += 1
+        fragment = self._fragments[track] = self.build(track)
+        if len(self._fragments) > self.size:
+            self._fragments.popitem(last=False)
+        return fragment
+
+    def stats(self):
+        return {
+            'entries': len(self._fragments),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def list_entry(track):
+    '''
+    a track in the queue or search results, after its number
+    '''
+    if track.source == 'gpm':
+        return (f' **{track.title}**\n'
+                f'        {track.album} / {track.artist}\n'
+                f'        from: gpm - {track.user}\n')
+    return (f' **{track.title}**\n'
+            f'        - from: {track.source}\n')
+
+def np_card(track):
+    '''
+    the now playing card between its title line and position
+    '''
+    if track.source == 'gpm':
+        return (f'        album: **{track.album}**\n'
+                f'        artist: **{track.artist}**\n'
+                '        from: **gpm**\n'
+                f'        owner: **{track.user}**\n'
+                f'        uri: {track.uri}\n')
+    return (f'        from: **{track.source}**\n'
+            f'        uri: <{track.uri}>\n')
+
+def split(text, limit=MESSAGE_LIMIT):
+    '''
+    cut text into messages discord accepts
+
+    cuts between lines, and inside a line only if it alone is too long. a
+    code block cut in two is closed at the end of one message and opened
+    again in the next.
+
+    Returns
+    -------
+    chunks: list of str, each at most limit characters; empty if the text
+            is only whitespace and code fences
+    '''
+    if len(text) <= limit:
+        return [text]
+
+    # leave room to close a code block, and to open it again
+    room = limit - len(FENCE) - 1
+    width = room - len(FENCE) - 1
+    chunks = []
+    lines = []
+    length = 0
+    fenced = False
+    for line in text.split('\n'):
+        for piece in [line[i:i + width] for i in range(0, len(line), width)] or ['']:
+            if lines and length + 1 + len(piece) > room:
+                chunks.append('\n'.join(lines + [FENCE] if fenced else lines))
+                lines = [FENCE] if fenced else []
+                length = len(FENCE) if fenced else 0
+            length += len(piece) + 1 if lines else len(piece)
+            lines.append(piece)
+            if piece.count(FENCE) % 2:
+                fenced = not fenced
+    chunks.append('\n'.join(lines))
+    # discord refuses empty messages
+    return [chunk for chunk in chunks if chunk.replace(FENCE, '').strip()]
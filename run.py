@@ -1,56 +1,113 @@
 import asyncio
-import threading
 import logging
 
 import aiohttp
 
 from bot import Music
+from codec import BACKEND, Codec
 from config import Config
-from websocket_client import ws_ctrl, ws_music
+from gateway import Gateway
+from jitter_buffer import JitterBuffer
+from lifecycle import Lifecycle
+from loop_watchdog import LoopWatchdog
+from metrics import LoopMonitor
+from player import FrameScheduler, Player
+from stream_hub import StreamHub
+from supervisor import AudioThread, BufferHandoff, Supervisor
+from telemetry import bind_process, bind_session, serve
+from websocket_client import OpMux, ws_ctrl
 
 logging.basicConfig(
                 level=logging.INFO,
                 format='[%(asctime)s][%(module)s] %(message)s'
             )
 
-async def main(loop):
-    player_queue = asyncio.Queue()
+def start_session(config, gateway, session, hub, supervisor, loop, audio, scheduler, registry, suffix=''):
+    '''
+    wire one voice session: its aria sockets, jitter buffer and player
+    '''
     res_queue = asyncio.Queue()
-    ctrl_queue = asyncio.Queue()
-    key: dict = {}
+    mux = OpMux(asyncio.Queue(), loop, config.op_timeout, config.max_pending_requests)
+    lifecycle = Lifecycle(loop)
 
-    config = Config('config/config.json', 'config/alias.json', 'config/blacklist.json', 'config/ops.json')
-    session = aiohttp.ClientSession()
+    buffer_args = (config.buffer_target_ms, config.buffer_low_ms, config.buffer_high_ms)
+    if audio:
+        player_queue = audio.create(JitterBuffer, *buffer_args)
+        player = Player(player_queue, audio.loop, lifecycle, scheduler)
+        stream_queue = BufferHandoff(player_queue, audio)
+    else:
+        player_queue = JitterBuffer(*buffer_args, loop)
+        player = Player(player_queue, loop, lifecycle, scheduler)
+        stream_queue = player_queue
 
     token = config.aria_token
 
-    discord = threading.Thread(target=discord_loader, args=(config, player_queue, res_queue, ctrl_queue, loop),name='discord',  daemon=True)
-    ctrl = threading.Thread(target=ctrl_loader, args=(ctrl_queue, res_queue, session, config.cmd_endpoint, key, token, loop), name='ctrl', daemon=True)
-    music = threading.Thread(target=music_loader, args=(player_queue, session, config.stream_endpoint, key, token, loop), name='music', daemon=True)
-    discord.start()
-    ctrl.start()
-    music.start()
+    backoff = (config.reconnect_delay, config.reconnect_max_delay)
+    music = Music(config, gateway, player, res_queue, mux, lifecycle, loop)
+    gateway.add(music)
+    decoder = Codec(loop, config.decode_offload_kb * 1024)
+    ctrl = ws_ctrl(mux, res_queue, session, config.cmd_endpoint, lifecycle, token, loop, backoff, decoder)
+    stream = hub.subscribe(stream_queue, config.stream_endpoint, lifecycle, token)
+
+    supervisor.add(f'responses{suffix}', music.handle_res)
+    supervisor.add(f'voice{suffix}', music.health.run)
+    supervisor.add(f'ctrl{suffix}', ctrl.link.run)
+    supervisor.add(f'music{suffix}', stream.run)
+    if registry:
+        bind_session(registry, music, ctrl, stream)
+    return music
+
+async def main(loop, supervisor):
+    config = Config('config/config.json', 'config/alias.json', 'config/blacklist.json', 'config/ops.json')
+    sessions = config.session_configs()
+
+    audio = None
+    if config.audio_thread:
+        audio = AudioThread()
+        audio.start()
+        supervisor.on_shutdown(audio.stop)
+    # one frame clock for all sessions instead of a task each
+    scheduler = FrameScheduler(audio.loop if audio else loop) if len(sessions) > 1 else None
+
+    session = aiohttp.ClientSession()
+    supervisor.on_shutdown(session.close)
+    # sessions playing the same aria stream share its websocket
+    backoff = (config.reconnect_delay, config.reconnect_max_delay)
+    hub = StreamHub(session, loop, backoff, config.stream_backlog_ms)
+    supervisor.on_shutdown(hub.close)
 
-def discord_loader(config, player_queue, res_queue, ctrl_queue, loop):
-    asyncio.set_event_loop(loop)
-    music = Music(config, player_queue, res_queue, ctrl_queue, loop)
-    loop.create_task(music.start(config.token))
+    gateway = Gateway(loop, config.shard_count)
+    supervisor.on_shutdown(gateway.close)
+    monitor = LoopMonitor(loop)
+    if config.watchdog_ms:
+        gateway.watchdog = LoopWatchdog(config.watchdog_ms / 1000)
+        # the watchdog's heartbeat also measures the lag /metrics shows
+        gateway.watchdog.watch('main', loop, monitor)
+        if audio:
+            gateway.watchdog.watch('audio', audio.loop)
+        gateway.watchdog.start()
+        supervisor.on_shutdown(gateway.watchdog.stop)
 
-def ctrl_loader(q1, q2, session, uri, key, token, loop):
-    asyncio.set_event_loop(loop)
-    ws = ws_ctrl(q1, q2, session, uri, key, token, loop)
-    loop.create_task(ws.receive_res())
+    registry = await serve(config, supervisor, monitor, gateway.watchdog)
+    if registry:
+        bind_process(registry, gateway, monitor, hub, scheduler)
+    logging.info(f'json backend: {BACKEND}, {len(sessions)} voice sessions')
+    for n, session_config in enumerate(sessions):
+        start_session(session_config, gateway, session, hub, supervisor, loop, audio, scheduler, registry,
+                      f':{session_config.voice_channel_id}' if n else '')
 
-def music_loader(q, session, uri, key, token, loop):
-    asyncio.set_event_loop(loop)
-    ws = ws_music(q, session, uri, key, token)
-    loop.create_task(ws.receive_music_bin())
+    supervisor.add('discord', lambda: gateway.start(config.token), restart=False)
+    supervisor.add('presence', gateway.presence.run)
+    await supervisor.wait()
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    loop.create_task(main(loop))
+    supervisor = Supervisor(loop)
 
     try:
-        loop.run_forever()
+        loop.run_until_complete(main(loop, supervisor))
     except KeyboardInterrupt:
+        logging.info('interrupted')
+    finally:
+        loop.run_until_complete(supervisor.shutdown())
         loop.close()
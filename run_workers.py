@@ -0,0 +1,98 @@
+'''
+run the bot with its voice sessions played by worker processes
+
+like run.py, but `voice_workers` processes play the voice sessions. this
+process keeps the discord gateway, the voice websockets, the commands and
+the ctrl websockets; each worker has the music streams, jitter buffers
+and players of its sessions and sends on their udp sockets.
+'''
+import asyncio
+import logging
+
+import aiohttp
+
+from bot import Music
+from codec import BACKEND, Codec
+from config import Config
+from gateway import Gateway
+from lifecycle import Lifecycle
+from loop_watchdog import LoopWatchdog
+from metrics import LoopMonitor
+from supervisor import Supervisor
+from telemetry import bind_process, bind_session, serve
+from websocket_client import OpMux, ws_ctrl
+from workers import RemotePlayer, WorkerPool
+
+logging.basicConfig(
+                level=logging.INFO,
+                format='[%(asctime)s][coordinator][%(module)s] %(message)s'
+            )
+
+def start_session(config, gateway, pool, session, supervisor, loop, registry, suffix=''):
+    res_queue = asyncio.Queue()
+    mux = OpMux(asyncio.Queue(), loop, config.op_timeout, config.max_pending_requests)
+    lifecycle = Lifecycle(loop)
+    player = RemotePlayer(pool, config.voice_channel_id, config, lifecycle)
+
+    backoff = (config.reconnect_delay, config.reconnect_max_delay)
+    music = Music(config, gateway, player, res_queue, mux, lifecycle, loop)
+    gateway.add(music)
+    decoder = Codec(loop, config.decode_offload_kb * 1024)
+    ctrl = ws_ctrl(mux, res_queue, session, config.cmd_endpoint, lifecycle, config.aria_token, loop, backoff, decoder)
+
+    supervisor.add(f'responses{suffix}', music.handle_res)
+    supervisor.add(f'voice{suffix}', music.health.run)
+    supervisor.add(f'ctrl{suffix}', ctrl.link.run)
+    supervisor.add(f'stages{suffix}', player.forward_stages)
+    if registry:
+        # player counters are the ones the worker reported with its last pong
+        bind_session(registry, music, ctrl)
+    return music
+
+async def main(loop, supervisor):
+    config = Config('config/config.json', 'config/alias.json', 'config/blacklist.json', 'config/ops.json')
+    sessions = config.session_configs()
+
+    pool = WorkerPool(loop, config.voice_workers)
+    pool.start()
+    supervisor.on_shutdown(pool.stop)
+
+    session = aiohttp.ClientSession()
+    supervisor.on_shutdown(session.close)
+
+    gateway = Gateway(loop, config.shard_count)
+    supervisor.on_shutdown(gateway.close)
+    monitor = LoopMonitor(loop)
+    if config.watchdog_ms:
+        gateway.watchdog = LoopWatchdog(config.watchdog_ms / 1000)
+        # the watchdog's heartbeat also measures the lag /metrics shows
+        gateway.watchdog.watch('coordinator', loop, monitor)
+        gateway.watchdog.start()
+        supervisor.on_shutdown(gateway.watchdog.stop)
+
+    registry = await serve(config, supervisor, monitor, gateway.watchdog)
+    if registry:
+        bind_process(registry, gateway, monitor)
+        registry.gauge('voice_workers', 'voice worker processes answering pings', lambda: pool.stats()['workers'])
+        registry.counter('voice_worker_respawns_total', 'voice workers replaced', lambda: pool.respawns)
+    logging.info(f'json backend: {BACKEND}, {len(sessions)} voice sessions on {config.voice_workers} workers')
+    for n, session_config in enumerate(sessions):
+        start_session(session_config, gateway, pool, session, supervisor, loop, registry,
+                      f':{session_config.voice_channel_id}' if n else '')
+
+    supervisor.add('discord', lambda: gateway.start(config.token), restart=False)
+    supervisor.add('presence', gateway.presence.run)
+    supervisor.add('workers', pool.run)
+    await supervisor.wait()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    supervisor = Supervisor(loop)
+
+    try:
+        loop.run_until_complete(main(loop, supervisor))
+    except KeyboardInterrupt:
+        logging.info('interrupted')
+    finally:
+        loop.run_until_complete(supervisor.shutdown())
+        loop.close()
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+import discord
+
+
+class ResultCache:
+    '''
+    parsed search results by (provider, query)
+
+    entries live for `ttl` seconds; past `size` entries the least recently
+    used one is evicted.
+    '''
+    def __init__(self, loop, size=64, ttl=300.0):
+        self.loop = loop
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(provider, query):
+        return (provider, ' '.join(query.lower().split()))
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry and self.loop.time() - entry[1] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, results):
+        self._entries[key] = (results, self.loop.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class SearchSession:
+    '''
+    one paginated search result message
+
+    every page is rendered up front and shown by editing the same message,
+    and the reactions are added once through the outbox while the user can
+    already pick. discord reports a click on a reaction that is already
+    there as a removal, so both count as a press: numbers toggle the track
+    on the current page, rewind/fast_forward turn the page.
+    '''
+    def __init__(self, client, dest, results, per_page, render, timeout=60.0):
+        '''
+        Parameters
+        ----------
+        client: Music
+        dest: discord.channel.TextChannel
+        results: list of Track
+        per_page: int, at most 9
+        render: coroutine function formatting one page of songs
+        '''
+        self.client = client
+        self.dest = dest
+        self.results = results
+        self.per_page = per_page
+        self.render = render
+        self.timeout = timeout
+        self.page = 0
+        self.chunks = [results[i:i + per_page] for i in range(0, len(results), per_page)]
+        self.pages = None
+        self.message = None
+
+    async def _render_pages(self):
+        header = f'**search result**\n**{len(self.results)}** hits\n'
+        self.pages = [f'{header}page: {n+1} / {len(self.chunks)}\n' + await self.render(chunk)
+                      for n, chunk in enumerate(self.chunks)]
+
+    def _add_reactions(self):
+        control = self.client.control
+        emojis = self.client.unicode_nums[:len(self.chunks[0])]
+        if len(self.chunks) > 1:
+            emojis += [control['rewind'], control['fast_forward']]
+        emojis += [control['no_entry_sign'], control['white_check_mark'], control['play_all']]
+        return self.client.outbox.react(self.message, emojis)
+
+    async def _show(self, page):
+        self.page = page
+        try:
+            await self.message.edit(content=self.pages[page])
+        except discord.HTTPException:
+            logging.error('cannot edit search result')
+
+    async def _next_press(self):
+        '''
+        Returns
+        -------
+        emoji: str, or None on timeout
+        '''
+        def check(reaction, user):
+            return user != self.client.gateway.user and reaction.message.id == self.message.id
+
+        waiters = [self.client.loop.create_task(self.client.gateway.wait_for(event, check=check))
+                   for event in ('reaction_add', 'reaction_remove')]
+        done, pending = await asyncio.wait(waiters, timeout=self.timeout,
+                                           return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        if not done:
+            return None
+        reaction, _ = done.pop().result()
+        return str(reaction.emoji)
+
+    async def run(self):
+        '''
+        Returns
+        -------
+        uris: list of picked uris, None if cancelled or timed out
+        '''
+        await self._render_pages()
+        self.message = await self.client.safe_send(self.dest, self.pages[0], merge=False)
+        if not self.message:
+            return None
+
+        control = self.client.control
+        # an ordered set of uris
+        picked = {}
+        adder = self._add_reactions()
+        try:
+            while True:
+                emoji = await self._next_press()
+                if emoji in (None, control['no_entry_sign']):
+                    return None
+                if emoji == control['white_check_mark']:
+                    return list(picked)
+                if emoji == control['play_all']:
+                    return [song.uri for song in self.results]
+                if emoji == control['fast_forward'] and self.page + 1 < len(self.pages):
+                    await self._show(self.page + 1)
+                elif emoji == control['rewind'] and self.page > 0:
+                    await self._show(self.page - 1)
+
+                select = self.client.inv_unicode_nums.get(emoji)
+                if select and select <= len(self.chunks[self.page]):
+                    uri = self.chunks[self.page][select-1].uri
+                    if uri in picked:
+                        del picked[uri]
+                    else:
+                        picked[uri] = None
+        finally:
+            adder.cancel()
+            await self.client.safe_delete(self.message)
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+
+import aiohttp
+
+from jitter_buffer import FRAME_MS
+from metrics import Counter, Histogram
+from reconnect import Reconnector
+
+# frames kept for subscribers that fall behind, 2s
+BACKLOG_MS = 2000
+
+
+class Upstream:
+    '''
+    one music websocket and the frames it received
+
+    frames go into a ring shared by every subscriber: the bytes aiohttp
+    hands over are stored once and each subscriber reads them through its
+    own cursor. the one copy per subscriber is the one its JitterBuffer
+    makes into a FrameRing slot, which FrameSender encrypts in place with
+    that session's key, so it cannot be shared. the reader only pauses
+    once even the subscriber furthest ahead is half the ring behind; one
+    that falls a whole ring behind skips the frames that were overwritten
+    and counts them as dropped.
+    '''
+    def __init__(self, hub, name, uri, token, capacity):
+        self.hub = hub
+        self.loop = hub.loop
+        self.uri = uri
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.capacity = capacity
+        self.pause_lag = max(1, capacity // 2)
+        self.ring = [None] * capacity
+        self.end = 0
+        # where the frames of the current connection start
+        self.start = 0
+        self.generation = 0
+        self.connected = False
+        self.pauses = 0
+        self.subscribers = set()
+        self.link = Reconnector(name, self.receive_music_bin, self.loop, *hub.backoff, hub.recovery)
+        self.task = None
+        self._waiters = []
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def _wake(self, *args):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait(self):
+        '''
+        until a frame arrives or the connection comes or goes
+        '''
+        waiter = self.loop.create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def read(self, subscriber):
+        '''
+        Returns
+        -------
+        frame: bytes, None if the subscriber is caught up
+        '''
+        cursor = subscriber.cursor
+        if cursor >= self.end:
+            return None
+        oldest = self.end - self.capacity
+        if cursor < oldest:
+            subscriber.dropped += oldest - cursor
+            cursor = oldest
+        frame = self.ring[cursor % self.capacity]
+        subscriber.cursor = cursor + 1
+        if not self._writable.is_set() and self.end - subscriber.cursor < self.pause_lag:
+            self._writable.set()
+        return frame
+
+    def _lag(self):
+        return min((self.end - subscriber.cursor for subscriber in self.subscribers), default=0)
+
+    async def _key(self):
+        '''
+        stream key of any subscriber; keys are handed out per ctrl
+        connection and each one opens the stream
+        '''
+        while True:
+            for subscriber in self.subscribers:
+                if subscriber.lifecycle.is_ready('key'):
+                    return subscriber.lifecycle.key
+            waits = [self.loop.create_task(subscriber.lifecycle.wait('key')) for subscriber in self.subscribers]
+            try:
+                await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for wait in waits:
+                    wait.cancel()
+
+    async def receive_music_bin(self):
+        key = await self._key()
+        async with self.hub.session.ws_connect(self.uri, headers=self.headers) as wsclient:
+            await wsclient.send_str(key)
+            logging.info(f'music ws connected, {len(self.subscribers)} subscribers')
+            self.start = self.end
+            self.generation += 1
+            self.connected = True
+            self._wake()
+            receiving = False
+            try:
+                async for msg in wsclient:
+                    if msg.type == aiohttp.WSMsgType.ERROR:
+                        break
+                    elif msg.type == aiohttp.WSMsgType.BINARY:
+                        if not receiving:
+                            receiving = True
+                            self.link.up()
+                        if self._lag() >= self.pause_lag:
+                            # every subscriber is full, stop reading the socket
+                            self.pauses += 1
+                            self._writable.clear()
+                            await self._writable.wait()
+                        self.ring[self.end % self.capacity] = msg.data
+                        self.end += 1
+                        self.hub.received.inc()
+                        self._wake()
+            finally:
+                self.connected = False
+                self._wake()
+        return False
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'frames': self.end,
+            'pauses': self.pauses,
+            **self.link.stats()
+        }
+
+
+class StreamSubscriber:
+    '''
+    one voice session reading a shared music stream into its player queue
+
+    once there is a key and someone listening, run() joins the upstream of
+    its stream, and leaves it when the channel empties.
+    '''
+    def __init__(self, hub, player_queue, uri, lifecycle, token):
+        self.hub = hub
+        self.player_queue = player_queue
+        self.uri = uri
+        self.lifecycle = lifecycle
+        self.token = token
+        self.upstream = None
+        self.cursor = 0
+        self.dropped = 0
+
+    async def _follow(self, upstream):
+        generation = None
+        while True:
+            if upstream.task.done():
+                # raises what stopped the upstream
+                upstream.task.result()
+                return
+            if upstream.connected and upstream.generation != generation:
+                # frames left from the last connection would play out of
+                # order; flushing also pre-rolls the new stream from a clean start
+                generation = upstream.generation
+                self.cursor = max(self.cursor, upstream.start)
+                self.player_queue.flush()
+                self.lifecycle.mark('stream')
+            elif not upstream.connected:
+                self.lifecycle.clear('stream')
+
+            frame = upstream.read(self)
+            if frame is None:
+                await upstream.wait()
+                continue
+            # blocks at the high watermark; the upstream only waits for the
+            # subscriber furthest ahead
+            await self.player_queue.put(frame)
+
+    async def run(self):
+        while True:
+            await self.lifecycle.wait('key', 'discord', 'listening')
+            upstream = self.upstream = self.hub.join(self)
+            follow = self.hub.loop.create_task(self._follow(upstream))
+            idle = self.hub.loop.create_task(self.lifecycle.wait_cleared('listening'))
+            try:
+                await asyncio.wait([follow, idle], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                follow.cancel()
+                idle.cancel()
+                self.hub.leave(self)
+                self.upstream = None
+                self.lifecycle.clear('stream')
+            if follow.done() and not follow.cancelled():
+                follow.result()
+            logging.info('nobody is listening, left the music stream')
+
+    def stats(self):
+        return {
+            'lag': self.upstream.end - self.cursor if self.upstream else 0,
+            'dropped': self.dropped
+        }
+
+
+class StreamHub:
+    '''
+    one music websocket per aria stream, shared by the sessions playing it
+
+    sessions with the same stream endpoint and aria token listen to the
+    same room, so they subscribe to one upstream instead of each receiving
+    the same frames. the upstream is opened by its first subscriber and
+    closed when the last one leaves. the upstreams come and go, so their
+    links record into one recovery histogram and drop count of the hub.
+    '''
+    def __init__(self, session, loop, backoff=(0.5, 30.0), backlog_ms=BACKLOG_MS):
+        self.session = session
+        self.loop = loop
+        self.backoff = backoff
+        self.capacity = max(2, backlog_ms // FRAME_MS)
+        self.upstreams = {}
+        self.opened = 0
+        self.received = Counter()
+        self.recovery = Histogram()
+        # drops of upstreams already closed
+        self._drops = 0
+
+    def subscribe(self, player_queue, uri, lifecycle, token):
+        return StreamSubscriber(self, player_queue, uri, lifecycle, token)
+
+    def join(self, subscriber):
+        stream = (subscriber.uri, subscriber.token)
+        upstream = self.upstreams.get(stream)
+        if upstream is None:
+            self.opened += 1
+            name = 'music' if self.opened == 1 else f'music#{self.opened}'
+            upstream = self.upstreams[stream] = Upstream(self, name, *stream, self.capacity)
+        # a new subscriber starts at the live edge
+        subscriber.cursor = upstream.end
+        upstream.subscribers.add(subscriber)
+        upstream._writable.set()
+        if upstream.task is None:
+            upstream.task = self.loop.create_task(upstream.link.run())
+            upstream.task.add_done_callback(upstream._wake)
+        return upstream
+
+    def leave(self, subscriber):
+        stream = (subscriber.uri, subscriber.token)
+        upstream = self.upstreams.get(stream)
+        if upstream is None:
+            return
+        upstream.subscribers.discard(subscriber)
+        upstream._writable.set()
+        if not upstream.subscribers:
+            logging.info('last subscriber left, closing music ws')
+            upstream.task.cancel()
+            self._drops += upstream.link.drops
+            del self.upstreams[stream]
+
+    async def close(self):
+        tasks = [upstream.task for upstream in self.upstreams.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._drops = self.drops()
+        self.upstreams.clear()
+
+    def drops(self):
+        return self._drops + sum(upstream.link.drops for upstream in self.upstreams.values())
+
+    def stats(self):
+        return {
+            'upstreams': len(self.upstreams),
+            'subscribers': sum(len(upstream.subscribers) for upstream in self.upstreams.values()),
+            'opened': self.opened
+        }
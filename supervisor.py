@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import threading
+
+
+class Supervisor:
+    '''
+    own the bot's long running coroutines on one loop
+
+    components are coroutine functions. a component that crashes or returns
+    is started again after a backoff that doubles up to max_delay; one added
+    with restart=False stops the whole bot when it exits instead.
+    shutdown() cancels every component and then runs the cleanup callbacks
+    in reverse order.
+    '''
+    def __init__(self, loop, delay=1.0, max_delay=60.0):
+        self.loop = loop
+        self.delay = delay
+        self.max_delay = max_delay
+        self.components = {}
+        self.restarts = {}
+        self._cleanups = []
+        self._stopped = asyncio.Event()
+
+    def add(self, name, factory, restart=True):
+        self.restarts[name] = 0
+        self.components[name] = self.loop.create_task(self._run(name, factory, restart))
+
+    def remove(self, name):
+        '''
+        stop a component for good
+        '''
+        task = self.components.pop(name, None)
+        self.restarts.pop(name, None)
+        if task:
+            task.cancel()
+
+    def on_shutdown(self, callback):
+        '''
+        callback: coroutine function run on shutdown
+        '''
+        self._cleanups.append(callback)
+
+    async def _run(self, name, factory, restart):
+        delay = self.delay
+        while True:
+            started = self.loop.time()
+            try:
+                await factory()
+                logging.warning(f'{name} exited')
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f'{name} crashed')
+
+            if not restart:
+                self._stopped.set()
+                return
+
+            if self.loop.time() - started > self.max_delay:
+                # it ran fine for a while, start over with a short backoff
+                delay = self.delay
+            self.restarts[name] += 1
+            logging.info(f'restarting {name} in {delay:.1f}s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    async def wait(self):
+        await self._stopped.wait()
+
+    async def shutdown(self):
+        self._stopped.set()
+        tasks = list(self.components.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for callback in reversed(self._cleanups):
+            try:
+                await callback()
+            except Exception:
+                logging.exception('error during shutdown')
+        self._cleanups.clear()
+
+
+class AudioThread:
+    '''
+    run the audio path on its own event loop
+
+    frames are then paced on a loop that never runs gateway or command work.
+    objects owning asyncio primitives must be built with create() so they
+    bind to this loop.
+    '''
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='audio', daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+
+    def create(self, factory, *args):
+        async def _create():
+            return factory(*args)
+        return asyncio.run_coroutine_threadsafe(_create(), self.loop).result()
+
+    async def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        await asyncio.get_event_loop().run_in_executor(None, self.thread.join, 1.0)
+
+
+class BufferHandoff:
+    '''
+    main loop side of a jitter buffer that lives on the audio thread
+    '''
+    def __init__(self, buffer, audio):
+        self.buffer = buffer
+        self.audio = audio
+        # each counter is only written by one thread
+        self._handed = 0
+        self._delivered = 0
+
+    def _deliver(self, frame):
+        self.buffer.put_nowait(frame)
+        self._delivered += 1
+
+    async def put(self, frame):
+        if self.buffer.qsize() + self._handed - self._delivered < self.buffer.high:
+            self._handed += 1
+            self.audio.loop.call_soon_threadsafe(self._deliver, frame)
+        else:
+            # full: wait on the audio loop so the websocket reader is paused
+            future = asyncio.run_coroutine_threadsafe(self.buffer.put(frame), self.audio.loop)
+            await asyncio.wrap_future(future)
+
+    def flush(self):
+        # queued after any frame handed over before it
+        self.audio.loop.call_soon_threadsafe(self.buffer.flush)
+
+    def stats(self):
+        return self.buffer.stats()
@@ -0,0 +1,139 @@
+'''
+what the metrics endpoint shows
+
+the components already count what matters in their own attributes and
+stats(); the bindings here read them when the endpoint is scraped, so the
+audio path pays nothing for being measured.
+'''
+from metrics import MetricsServer, Registry
+
+PREFIX = 'aria_bot_'
+
+
+async def serve(config, supervisor, monitor, watchdog=None):
+    '''
+    start the endpoint when metrics_port is set, and the loop monitor's own
+    heartbeat unless the watchdog already beats on its loop
+
+    Returns
+    -------
+    registry: Registry, None if metrics are off
+    '''
+    if not config.metrics_port:
+        return None
+    registry = Registry(PREFIX)
+    server = MetricsServer(registry, config.metrics_host, config.metrics_port)
+    await server.start()
+    supervisor.on_shutdown(server.stop)
+    if not watchdog:
+        supervisor.add('loop monitor', monitor.run)
+    return registry
+
+def bind_process(registry, gateway, monitor, hub=None, scheduler=None):
+    '''
+    metrics shared by every session: the event loop, discord, the music
+    streams and the frame clock
+    '''
+    registry.histogram('loop_lag_seconds', 'how late the event loop ran a timer', monitor.lag)
+    registry.gauge('loop_lag_last_seconds', 'event loop lag of the last sample', lambda: monitor.last)
+    registry.gauge('tasks_pending', 'asyncio tasks not done yet', monitor.tasks)
+
+    watchdog = gateway.watchdog
+    if watchdog:
+        registry.counter('loop_stalls_total', 'event loop blocked for watchdog_ms or more',
+                         lambda: watchdog.stalls)
+
+    outbox = gateway.outbox
+    registry.counter('discord_rate_limited_total', 'discord 429 responses', lambda: outbox.rate_limits.count)
+    registry.counter('discord_messages_sent_total', 'messages sent through the outbox', lambda: outbox.sent)
+    registry.gauge('discord_outbox_depth', 'discord calls waiting in the outbox',
+                   lambda: outbox.stats()['depth'])
+    presence = gateway.presence
+    registry.counter('presence_updates_total', 'presence changes sent to discord', lambda: presence.sent)
+    registry.counter('presence_suppressed_total', 'presence changes debounced or unchanged',
+                     lambda: presence.suppressed)
+
+    if hub:
+        registry.counter('stream_frames_received_total', 'opus frames received from aria', hub.received.get)
+        registry.gauge('stream_upstreams', 'music websockets open', lambda: len(hub.upstreams))
+        registry.counter('link_drops_total', 'aria websocket drops', hub.drops, link='stream')
+        registry.histogram('link_recovery_seconds', 'aria websocket drop to working again', hub.recovery,
+                           link='stream')
+
+    if scheduler:
+        registry.counter('frame_rounds_total', 'frame clock rounds', lambda: scheduler.stats()['rounds'])
+        registry.counter('frame_rounds_late_total', 'frame clock rounds past their 20ms slot',
+                         lambda: scheduler.stats()['late'])
+        registry.gauge('frame_clock_players', 'players on the frame clock', lambda: scheduler.stats()['players'])
+
+def bind_session(registry, music, ctrl, stream=None):
+    '''
+    metrics of one voice session, labelled with its voice channel
+    '''
+    session = music.config.voice_channel_id
+    player = music.player
+    for key, name, help in (('sent', 'frames_sent_total', 'opus frames sent to discord'),
+                            ('late', 'frames_late_total', 'frames sent after their 20ms slot'),
+                            ('dropped', 'frames_dropped_total', 'frames discarded while the voice client was not connected'),
+                            ('underruns', 'buffer_underruns_total', 'jitter buffer ran dry while playing'),
+                            ('overruns', 'buffer_overruns_total', 'frames dropped from a full jitter buffer')):
+        registry.counter(name, help, lambda key=key: player.stats().get(key, 0), session=session)
+    registry.gauge('buffer_depth_ms', 'audio in the jitter buffer',
+                   lambda: player.stats().get('depth_ms', 0), session=session)
+    if stream:
+        registry.counter('stream_frames_skipped_total', 'frames a slow session skipped on a shared stream',
+                         lambda: stream.dropped, session=session)
+
+    mux = music.mux
+    for op, rtt in mux.rtt.items():
+        registry.histogram('op_rtt_seconds', 'aria op write to reply', rtt, session=session, op=op)
+    registry.histogram('op_latency_seconds', 'aria op post to write', ctrl.latency, session=session)
+    registry.counter('op_timeouts_total', 'aria ops without a reply in time', lambda: mux.timeouts, session=session)
+    registry.gauge('ops_pending', 'aria ops waiting for a reply', lambda: len(mux.pending), session=session)
+    registry.counter('link_drops_total', 'aria websocket drops', lambda: ctrl.link.drops,
+                     session=session, link='ctrl')
+    registry.histogram('link_recovery_seconds', 'aria websocket drop to working again', ctrl.link.recovery,
+                       session=session, link='ctrl')
+
+    dispatcher = music.dispatcher
+    for response_type, timing in dispatcher.timings.items():
+        registry.counter('responses_received_total', 'ctrl responses by type',
+                         lambda response_type=response_type: dispatcher.received[response_type],
+                         session=session, type=response_type)
+        registry.counter('responses_coalesced_total', 'responses replaced by a newer one before handling',
+                         lambda response_type=response_type: dispatcher.coalesced[response_type],
+                         session=session, type=response_type)
+        registry.histogram('response_handler_seconds', 'time a response handler ran', timing,
+                           session=session, type=response_type)
+
+    commands = music.commands
+    registry.histogram('command_lookup_seconds', 'command name to handler', commands.lookups, session=session)
+    for name in commands.invocations:
+        registry.counter('commands_invoked_total', 'commands run', lambda name=name: commands.invocations[name],
+                         session=session, command=name)
+
+    decoder = ctrl.decoder
+    for key, name, help in (('decoded', 'ctrl_decoded_total', 'ctrl messages decoded'),
+                            ('offloaded', 'ctrl_decode_offloaded_total', 'ctrl messages decoded in the executor'),
+                            ('failed', 'ctrl_decode_failed_total', 'ctrl messages that were not valid json')):
+        registry.counter(name, help, lambda key=key: decoder.stats()[key], session=session)
+    registry.gauge('json_backend_info', 'json library decoding ctrl messages', lambda: 1,
+                   session=session, backend=decoder.stats()['backend'])
+
+    cache = music.search_cache
+    registry.counter('search_cache_hits_total', 'searches answered from the cache',
+                     lambda: cache.stats()['hits'], session=session)
+    registry.counter('search_cache_misses_total', 'searches sent to aria', lambda: cache.stats()['misses'], session=session)
+    registry.gauge('search_cache_entries', 'search results cached', lambda: cache.stats()['entries'], session=session)
+
+    for cache, kind in ((music.list_entries, 'list_entry'), (music.np_cards, 'np_card')):
+        registry.counter('fragment_cache_hits_total', 'rendered track text reused',
+                         lambda cache=cache: cache.stats()['hits'], session=session, fragment=kind)
+        registry.counter('fragment_cache_misses_total', 'track text rendered',
+                         lambda cache=cache: cache.stats()['misses'], session=session, fragment=kind)
+
+    health = music.health
+    registry.counter('voice_reconnects_total', 'voice reconnects after degraded sending',
+                     lambda: health.stats()['reconnects'], session=session)
+    registry.counter('voice_reconnects_held_off_total', 'voice reconnects skipped in the cooldown',
+                     lambda: health.stats()['held_off'], session=session)
@@ -0,0 +1,27 @@
+import asyncio
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bot import Music
+from outbox import MESSAGE_LIMIT
+
+
+class SafeSendTest(unittest.TestCase):
+    def test_nothing_to_send(self):
+        loop = asyncio.new_event_loop()
+        outbox = SimpleNamespace(send=lambda *args: self.fail('sent an empty message'))
+        music = SimpleNamespace(outbox=outbox)
+        payload = '```\n' + ' ' * MESSAGE_LIMIT + '\n```'
+        try:
+            msg = loop.run_until_complete(Music.safe_send(music, None, payload))
+        finally:
+            loop.close()
+        self.assertIsNone(msg)
+
+
+if __name__ == '__main__':
+    unittest.main()
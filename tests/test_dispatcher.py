@@ -0,0 +1,45 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dispatcher import Dispatcher
+
+
+class LatestKeyTest(unittest.TestCase):
+    def test_types_sharing_a_key_keep_arrival_order(self):
+        loop = asyncio.new_event_loop()
+        handled = []
+
+        async def set_play_queue(res):
+            handled.append(res['n'])
+
+        async def run():
+            dispatcher = Dispatcher(loop)
+            dispatcher.add_pool('events', 1)
+            dispatcher.register('list_queue', set_play_queue, 'events', latest_only=True, latest_key='queue')
+            dispatcher.register('event_queue_change', set_play_queue, 'events', latest_only=True,
+                                latest_key='queue')
+            res_queue = asyncio.Queue()
+            for n, response_type in enumerate(('list_queue', 'list_queue', 'event_queue_change', 'list_queue')):
+                res_queue.put_nowait({'type': response_type, 'n': n})
+            task = loop.create_task(dispatcher.run(res_queue))
+            for _ in range(10):
+                await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return dispatcher
+
+        try:
+            dispatcher = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        # all four wait in one slot, so only the newest queue is set
+        self.assertEqual(handled, [3])
+        self.assertEqual(dispatcher.coalesced['list_queue'] + dispatcher.coalesced['event_queue_change'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
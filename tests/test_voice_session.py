@@ -0,0 +1,39 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from voice_session import IdlePolicy
+
+
+class IdlePolicyTest(unittest.TestCase):
+    def test_empty_channel_goes_idle_once(self):
+        loop = asyncio.new_event_loop()
+        fired = []
+
+        async def run():
+            async def go_idle():
+                fired.append(loop.time())
+                # leaving clears 'listening', which updates the policy again
+                policy.update(0)
+
+            policy = IdlePolicy(loop, 0.01, go_idle)
+            policy.update(0)
+            await asyncio.sleep(0.1)
+            self.assertIsNone(policy._timer)
+            # someone listens and leaves again: idle once more
+            policy.update(1)
+            policy.update(0)
+            await asyncio.sleep(0.1)
+
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual(len(fired), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
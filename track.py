@@ -0,0 +1,56 @@
+from collections import namedtuple
+
+# one shared copy of each source/artist/album/user string
+_strings = {}
+_STRINGS_MAX = 100000
+
+_new = tuple.__new__
+
+
+class Track(namedtuple('Track', 'source title artist album user uri thumbnail duration')):
+    '''
+    one aria entry, flattened the way the bot shows it
+
+    immutable and no bigger than a tuple. source, artist, album and user
+    repeat all over a library, so they are interned and every track of an
+    album shares one copy of each.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_entry(cls, entry):
+        '''
+        Parameters
+        ----------
+        entry: dict, a search result, queue entry or now playing entry
+        '''
+        if len(_strings) > _STRINGS_MAX:
+            _strings.clear()
+        intern = _strings.setdefault
+        meta = entry.get('entry')
+        source = entry.get('source')
+        if meta:
+            # gpm keeps the track tags one level down
+            artist, album, user = meta.get('artist'), meta.get('album'), meta.get('user')
+            return _new(cls, (
+                intern(source, source),
+                meta.get('title'),
+                intern(artist, artist),
+                intern(album, album),
+                intern(user, user),
+                entry.get('uri'),
+                entry.get('thumbnail_small'),
+                entry.get('duration')
+            ))
+        return _new(cls, (
+            intern(source, source),
+            entry.get('title'),
+            None,
+            None,
+            None,
+            entry.get('uri'),
+            entry.get('thumbnail_small'),
+            entry.get('duration')
+        ))
+
+NO_TRACK = Track(None, None, None, None, None, None, None, None)
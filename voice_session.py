@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+
+class VoiceHealth:
+    '''
+    reconnect the voice client only when its connection is degraded
+
+    a reconnect redoes udp discovery and the encryption handshake and loses
+    every buffered frame, so it is kept for when the voice websocket missed
+    `missed_heartbeats` heartbeat acks in a row or at least `udp_errors`
+    packets failed to send since the last check. reconnects are at least
+    `cooldown` seconds apart.
+    '''
+    def __init__(self, client, player, loop, interval=5.0, missed_heartbeats=3, udp_errors=10, cooldown=30.0):
+        self.client = client
+        self.player = player
+        self.loop = loop
+        self.interval = interval
+        self.missed_heartbeats = missed_heartbeats
+        self.udp_errors = udp_errors
+        self.cooldown = cooldown
+        self.reconnects = 0
+        self.held_off = 0
+        self._last_reconnect = None
+        # (sender, its udp_errors at the last check); a new voice gets a new sender
+        self._seen = (None, 0)
+
+    def degraded(self):
+        '''
+        Returns
+        -------
+        reason: str, or None if the connection looks fine
+        '''
+        voice = self.client.voice
+        keep_alive = getattr(voice.ws, '_keep_alive', None)
+        if keep_alive and keep_alive.interval:
+            silent = time.perf_counter() - keep_alive._last_ack
+            if silent > keep_alive.interval * self.missed_heartbeats:
+                return f'no heartbeat ack for {silent:.1f}s'
+
+        sender = self.player.sender
+        if not sender:
+            return None
+        last_sender, last_errors = self._seen
+        errors = sender.udp_errors - (last_errors if sender is last_sender else 0)
+        self._seen = (sender, sender.udp_errors)
+        if errors >= self.udp_errors:
+            return f'{errors} udp send errors'
+        return None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.client.voice or not self.client.voice.is_connected():
+                # left on purpose, or discord.py is already reconnecting it
+                continue
+            reason = self.degraded()
+            if not reason:
+                continue
+
+            now = self.loop.time()
+            if self._last_reconnect is not None and now - self._last_reconnect < self.cooldown:
+                self.held_off += 1
+                logging.warning(f'voice degraded ({reason}), in reconnect cooldown')
+                continue
+            logging.warning(f'voice degraded ({reason}), reconnecting')
+            self._last_reconnect = now
+            self.reconnects += 1
+            await self.client.cmd_reconnect()
+
+    def stats(self):
+        return {
+            'reconnects': self.reconnects,
+            'held_off': self.held_off
+        }
+
+
+class IdlePolicy:
+    '''
+    call on_idle once the voice channel has had no listeners for `timeout`
+    seconds; a timeout of 0 never goes idle
+
+    once idle it stays quiet until someone listens again or the bot
+    rejoins, so an empty channel does not go idle over and over.
+    '''
+    def __init__(self, loop, timeout, on_idle):
+        self.loop = loop
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.idle = False
+        self._timer = None
+
+    def update(self, listeners):
+        if listeners:
+            self.idle = False
+        if listeners or not self.timeout:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        elif not self._timer and not self.idle:
+            self._timer = self.loop.call_later(self.timeout, self._fire)
+
+    def rejoined(self):
+        self.idle = False
+
+    def _fire(self):
+        self._timer = None
+        self.idle = True
+        self.loop.create_task(self.on_idle())
@@ -0,0 +1,214 @@
+'''
+voice worker process, started by workers.WorkerPool
+
+plays the voice sessions the coordinator attaches: each one gets its own
+jitter buffer and player, reads its music stream through the worker's
+StreamHub, and sends on the voice udp socket the coordinator hands over,
+so encryption and frame pacing run on this process's interpreter.
+'''
+import asyncio
+import logging
+import os
+import socket
+from multiprocessing import reduction
+
+import aiohttp
+import discord
+from jitter_buffer import JitterBuffer
+from lifecycle import Lifecycle
+from player import FrameScheduler, Player
+from supervisor import Supervisor
+from stream_hub import StreamHub
+
+
+class Encoder:
+    SAMPLES_PER_FRAME = 960
+
+
+class RemoteVoice:
+    '''
+    the part of a connected VoiceClient that sending needs
+
+    the coordinator keeps the voice websocket; this end gets the udp
+    socket, the encryption key and where the rtp counters left off.
+    '''
+    checked_add = discord.VoiceClient.checked_add
+    send_audio_packet = discord.VoiceClient.send_audio_packet
+    _get_voice_packet = discord.VoiceClient._get_voice_packet
+    _encrypt_xsalsa20_poly1305 = discord.VoiceClient._encrypt_xsalsa20_poly1305
+    _encrypt_xsalsa20_poly1305_suffix = discord.VoiceClient._encrypt_xsalsa20_poly1305_suffix
+    # only discord.py versions that negotiate the lite mode have it
+    _encrypt_xsalsa20_poly1305_lite = getattr(discord.VoiceClient, '_encrypt_xsalsa20_poly1305_lite', None)
+
+    def __init__(self, params, fd):
+        self.mode = params['mode']
+        self.secret_key = params['secret_key']
+        self.ssrc = params['ssrc']
+        self.endpoint_ip = params['endpoint_ip']
+        self.voice_port = params['voice_port']
+        self.sequence = params['sequence']
+        self.timestamp = params['timestamp']
+        self._lite_nonce = params['lite_nonce']
+        self.encoder = Encoder()
+        self.socket = socket.socket(fileno=fd)
+        self.socket.setblocking(False)
+
+    def is_connected(self):
+        return self.socket.fileno() != -1
+
+    def close(self):
+        self.socket.close()
+
+
+class WorkerSession:
+    '''
+    one attached voice session
+    '''
+    def __init__(self, worker, session_id, config):
+        self.session_id = session_id
+        loop = worker.loop
+        self.lifecycle = Lifecycle(loop)
+        self.buffer = JitterBuffer(config['buffer_target_ms'], config['buffer_low_ms'], config['buffer_high_ms'], loop)
+        self.player = Player(self.buffer, loop, self.lifecycle, worker.scheduler)
+        self.stream = worker.hub(config).subscribe(self.buffer, config['stream_endpoint'], self.lifecycle,
+                                                   config['aria_token'])
+        self.voice = None
+
+    def attach(self, params, fd):
+        if self.voice:
+            self.voice.close()
+        self.voice = RemoteVoice(params, fd)
+        self.player.voice = self.voice
+        self.lifecycle.mark('discord')
+        self.player.start()
+
+    def close(self):
+        self.player.stop()
+        self.player.voice = None
+        if self.voice:
+            self.voice.close()
+
+    def stats(self):
+        voice = self.voice
+        return {
+            **self.player.stats(),
+            'udp_errors': self.player.sender.udp_errors if self.player.sender else 0,
+            'sequence': voice.sequence if voice else 0,
+            'timestamp': voice.timestamp if voice else 0,
+            'lite_nonce': voice._lite_nonce if voice else 0
+        }
+
+
+class VoiceWorker:
+    '''
+    serve coordinator messages on conn until it goes away
+
+    messages are dicts with an `op`:
+      attach   session id, config, voice params, stream key and stages,
+               followed by the udp socket as a passed fd; sent again when
+               the voice changes
+      detach   session id
+      stage    session id, stage (key or listening), ready, key
+      flush / rebuffer   session id
+      ping     seq; answered with pong, seq and the stats of every session
+    '''
+    def __init__(self, conn, loop):
+        self.conn = conn
+        self.loop = loop
+        self.scheduler = FrameScheduler(loop)
+        self.supervisor = Supervisor(loop)
+        self.session = None
+        self.sessions = {}
+        self._hub = None
+        self._closed = asyncio.Event()
+
+    def hub(self, config):
+        '''
+        the music streams of this worker, shared by its sessions
+        '''
+        if self._hub is None:
+            self._hub = StreamHub(self.session, self.loop, config['backoff'], config['stream_backlog_ms'])
+        return self._hub
+
+    def _readable(self):
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                self.handle(message)
+        except (EOFError, OSError):
+            logging.warning('coordinator is gone')
+            self.loop.remove_reader(self.conn.fileno())
+            self._closed.set()
+
+    def handle(self, message):
+        op = message.get('op')
+        sid = message.get('session')
+        if op == 'ping':
+            stats = {sid: session.stats() for sid, session in self.sessions.items()}
+            self.conn.send({'op': 'pong', 'seq': message.get('seq'), 'stats': stats})
+        elif op == 'attach':
+            # the socket follows right behind the message
+            fd = reduction.recv_handle(self.conn)
+            session = self.sessions.get(sid)
+            if session is None:
+                session = self.sessions[sid] = WorkerSession(self, sid, message.get('config'))
+                self.supervisor.add(f'music:{sid}', session.stream.run)
+            session.attach(message.get('voice'), fd)
+            # stages the coordinator reached before this worker had the session
+            session.lifecycle.key = message.get('key')
+            for stage, ready in message.get('stages').items():
+                if ready:
+                    session.lifecycle.mark(stage)
+                else:
+                    session.lifecycle.clear(stage)
+            logging.info(f'session {sid} attached')
+        elif op == 'detach':
+            session = self.sessions.pop(sid, None)
+            if session:
+                self.supervisor.remove(f'music:{sid}')
+                session.close()
+                logging.info(f'session {sid} detached')
+        elif op == 'stage':
+            session = self.sessions.get(sid)
+            if not session:
+                return
+            if message.get('key'):
+                session.lifecycle.key = message.get('key')
+            if message.get('ready'):
+                session.lifecycle.mark(message.get('stage'))
+            else:
+                session.lifecycle.clear(message.get('stage'))
+        elif op in ('flush', 'rebuffer'):
+            session = self.sessions.get(sid)
+            if session:
+                getattr(session.player, op)()
+
+    async def run(self):
+        self.session = aiohttp.ClientSession()
+        self.loop.add_reader(self.conn.fileno(), self._readable)
+        self.conn.send({'op': 'hello', 'pid': os.getpid()})
+        try:
+            await self._closed.wait()
+        finally:
+            for session in self.sessions.values():
+                session.close()
+            await self.supervisor.shutdown()
+            if self._hub:
+                await self._hub.close()
+            await self.session.close()
+
+
+def main(conn, index):
+    logging.basicConfig(
+                level=logging.INFO,
+                format=f'[%(asctime)s][worker {index}][%(module)s] %(message)s'
+            )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = VoiceWorker(conn, loop)
+    try:
+        loop.run_until_complete(worker.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
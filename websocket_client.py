@@ -1,91 +1,297 @@
 import asyncio
-import json
+import itertools
 import logging
-import threading
+from collections import deque
 
-import aiohttp
+import codec
+from metrics import Histogram
+from reconnect import Reconnector
 
-lock = asyncio.Lock()
-event = threading.Event()
+# read-only ops: repeats within one burst get a single answer
+QUERY_OPS = ('state', 'list_queue', 'playlists', 'playlist')
 
-class ws_ctrl():
-    def __init__(self, ctrl_queue, res_queue, session, uri, key, token, loop):
+# ops the server answers, and the response type it answers with
+REPLY_TYPES = {
+    'search': 'search',
+    'list_queue': 'list_queue',
+    'state': 'state',
+    'playlists': 'playlists',
+    'playlist': 'playlist',
+    'token': 'token',
+    'invite': 'invite'
+}
+
+class Op():
+    '''
+    an op waiting in ctrl_queue
+    '''
+    __slots__ = ('op', 'data', 'postback', 'posted_at', 'sent',
+                 'req_id', 'reply', 'dispatch', 'timer', 'group', 'written_at')
+
+    def __init__(self, op, data=None, postback=None, posted_at=0.0, sent=None):
+        self.op = op
+        self.data = data
+        self.postback = postback
+        self.posted_at = posted_at
+        self.sent = sent
+        self.req_id = None
+        self.reply = None
+        self.dispatch = True
+        self.timer = None
+        self.group = None
+        self.written_at = None
+
+    @property
+    def wire_postback(self):
+        '''
+        the server echoes postback back, so it carries the request id too
+        '''
+        if self.req_id:
+            return f'{self.postback}:{self.req_id}'
+        return self.postback
+
+    def __repr__(self):
+        return repr((self.op, self.data, self.wire_postback))
+
+class OpMux():
+    '''
+    queue ops for ws_ctrl and match responses to the ops that asked for them
+
+    post() returns a future: for ops in REPLY_TYPES it resolves with the
+    response, for the rest once the op's write starts. a reply that does not
+    arrive within `timeout` fails the future with asyncio.TimeoutError, and
+    cancelling the future drops the op if its write has not started. at most
+    `max_pending` replies are awaited at once, later posts wait for a slot.
+    '''
+    def __init__(self, ctrl_queue, loop, timeout=10.0, max_pending=32):
         self.ctrl_queue = ctrl_queue
+        self.loop = loop
+        self.timeout = timeout
+        self.pending = {}
+        self.rtt = {op: Histogram() for op in REPLY_TYPES}
+        self.timeouts = 0
+        self._ids = itertools.count(1)
+        self._slots = asyncio.Semaphore(max_pending)
+
+    async def post(self, op, data=None, postback=None, dispatch=True):
+        '''
+        dispatch: also hand the response to Music's response handlers
+        '''
+        op = Op(op, data, postback, self.loop.time(), self.loop.create_future())
+        if op.op not in REPLY_TYPES:
+            self.ctrl_queue.put_nowait(op)
+            return op.sent
+
+        await self._slots.acquire()
+        op.req_id = str(next(self._ids))
+        op.dispatch = dispatch
+        op.reply = self.loop.create_future()
+        op.reply.add_done_callback(lambda _: self._done(op))
+        op.timer = self.loop.call_later(self.timeout, self._expire, op)
+        self.pending[op.req_id] = op
+        self.ctrl_queue.put_nowait(op)
+        return op.reply
+
+    def _expire(self, op):
+        if not op.reply.done():
+            self.timeouts += 1
+            logging.warning(f'no reply to {op} in {self.timeout}s')
+            op.reply.set_exception(asyncio.TimeoutError())
+
+    def _done(self, op):
+        self.pending.pop(op.req_id, None)
+        op.timer.cancel()
+        self._slots.release()
+        if not op.reply.cancelled():
+            # nobody may be awaiting a fire-and-forget request
+            op.reply.exception()
+
+    def resolve(self, req_id, res):
+        '''
+        Returns
+        -------
+        consumed: bool, True if no handler wants the response dispatched
+        '''
+        op = self.pending.get(req_id)
+        if not op:
+            return False
+        if op.written_at is not None:
+            rtt = self.rtt.setdefault(op.op, Histogram())
+            rtt.observe(self.loop.time() - op.written_at)
+            if rtt.count % 100 == 0:
+                logging.info(f'{op.op} round trip: {rtt}')
+
+        group = op.group or [op]
+        for member in group:
+            if not member.reply.done():
+                member.reply.set_result(res)
+        return not any(member.dispatch for member in group)
+
+    def unanswered(self):
+        '''
+        ops written to a link that dropped before their reply came back
+
+        Returns
+        -------
+        groups: list of (op to send again, [ops it answers for]), oldest first
+        '''
+        ops = sorted((op for op in self.pending.values()
+                      if op.written_at is not None and not op.reply.done()),
+                     key=lambda op: op.written_at)
+        for op in ops:
+            op.written_at = None
+        return [(op, op.group or [op]) for op in ops]
+
+class ws_ctrl():
+    def __init__(self, mux, res_queue, session, uri, lifecycle, token, loop, backoff=(0.5, 30.0),
+                 decoder=None):
+        self.mux = mux
+        self.ctrl_queue = mux.ctrl_queue
         self.res_queue = res_queue
         self.session = session
         self.uri = uri
-        self.global_key = key
+        self.lifecycle = lifecycle
         self.loop = loop
         self.headers = {'Authorization': f'Bearer {token}'}
+        self.latency = Histogram()
+        self.sender = None
+        # coalesced groups not written yet, kept across reconnects
+        self.unsent = deque()
+        self.replayed = 0
+        self.link = Reconnector('ctrl', self.receive_res, loop, *backoff)
+        self.decoder = decoder or codec.Codec(loop)
 
     async def post_op(self, wsclient):
-        op = ''
-        async with lock:
-            if not self.ctrl_queue.empty():
-                op = self.ctrl_queue.get_nowait()
-
-        if op:
-            if op[0] == 'discord ready':
-                event.set()
-            else:
-                await wsclient.send_json(enclose_packet(op[0], op[1], op[2]))
-                logging.info(f'post: {op}')
-        await asyncio.sleep(0.5)
-        self.loop.create_task(self.post_op(wsclient))
+        '''
+        send ops as soon as they are posted
+
+        a group leaves self.unsent only once it is written, so a burst the
+        link dropped in the middle of goes out on the next connection.
+        '''
+        while True:
+            if not self.unsent:
+                ops = [await self.ctrl_queue.get()]
+                while not self.ctrl_queue.empty():
+                    ops.append(self.ctrl_queue.get_nowait())
+                # timed out or cancelled before we got to them
+                ops = [op for op in ops if not (op.reply and op.reply.done()) and not op.sent.cancelled()]
+                self.unsent.extend(coalesce(ops))
+                continue
+
+            op, members = self.unsent[0]
+            if op.reply and all(member.reply.done() for member in members):
+                self.unsent.popleft()
+                continue
+            if all(member.sent.cancelled() for member in members):
+                # the poster gave up waiting for the write
+                self.unsent.popleft()
+                continue
+            if len(members) > 1:
+                op.group = members
+            # from here the op goes out, on this connection or the next, so
+            # a poster that stops waiting must not count it as unsent
+            for member in members:
+                if member.sent and not member.sent.done():
+                    member.sent.set_result(None)
+            await wsclient.send_json(enclose_packet(op.op, op.data, op.wire_postback), dumps=codec.dumps)
+            self.unsent.popleft()
+            now = self.loop.time()
+            op.written_at = now
+            for member in members:
+                self.latency.observe(now - member.posted_at)
+            logging.debug(f'post: {op}')
+
+            if self.latency.count % 100 < len(members):
+                logging.info(f'op latency: {self.latency}')
 
     async def receive_res(self):
-        wsclient = await self.session.ws_connect(self.uri, headers=self.headers)
-        logging.info('res ws connected')
-        async for msg in wsclient:
+        async with self.session.ws_connect(self.uri, headers=self.headers) as wsclient:
+            logging.info('res ws connected')
             try:
-                res = msg.json()
-            except:
+                await self._receive_res(wsclient)
+            finally:
+                if self.sender:
+                    self.sender.cancel()
+                    self.sender = None
+                # the stream has to wait for the key of the next connection
+                self.lifecycle.key = None
+                self.lifecycle.clear('key')
+
+    async def _receive_res(self, wsclient):
+        async for msg in wsclient:
+            res, req_id = await self.decoder.decode(msg.data)
+            if res is None:
                 logging.error(f'Failed to parse: {msg.data}')
                 continue
 
-            # convert postback to int
-            try:
-                res['postback'] = int(res['postback'])
-            except:
-                # logging.error('You gaiji: ', exc_info=True)
-                pass
+            if req_id and self.mux.resolve(req_id, res):
+                continue
 
             #logging.info(res)
             #logging.info(res.get('type'))
             if res.get('type') == 'hello':
-                async with lock:
-                    self.global_key['key'] = res.get('key')
-                    logging.info(f'ws key: {self.global_key}')
-                self.loop.create_task(self.post_op(wsclient))
+                self.lifecycle.key = res.get('key')
+                logging.info(f'ws key: {self.lifecycle.key}')
+                self.lifecycle.mark('key')
+                # replies lost with the old connection; ops that change
+                # state are not sent twice, the server may have applied them
+                replay = self.mux.unanswered()
+                self.unsent.extendleft(reversed(replay))
+                self.replayed += len(replay)
+                if self.sender:
+                    self.sender.cancel()
+                self.sender = self.loop.create_task(self.post_op(wsclient))
+                self.link.up()
             else:
-                async with lock:
-                    self.res_queue.put_nowait(res)
+                self.res_queue.put_nowait(res)
 
-class ws_music():
-    def __init__(self, player_queue, session, uri, key, token):
-        self.player_queue = player_queue
-        self.session = session
-        self.uri = uri
-        self.key = key
-        self.headers = {'Authorization': f'Bearer {token}'}
+def coalesce(ops):
+    '''
+    fold a burst of ops into as few packets as the protocol allows
 
-    async def receive_music_bin(self):
-        while not event.wait(timeout=0.5):
-            await asyncio.sleep(1)
+    consecutive plain `queue` ops for the same postback become one `queue`
+    with a uri list, and repeated read-only queries are sent once.
 
-        async with self.session.ws_connect(self.uri, headers=self.headers) as wsclient:
-            async with lock:
-                key = self.key.get('key')
-
-            await wsclient.send_str(key)
-            logging.info('music ws connected')
-            async for msg in wsclient:
-                #logging.debug(msg.data)
-                if msg.type == aiohttp.WSMsgType.ERROR:
-                    break
-                elif msg.type == aiohttp.WSMsgType.BINARY:
-                    async with lock:
-                        self.player_queue.put_nowait(msg.data)
+    Returns
+    -------
+    groups: list of (op to send, [ops it answers for])
+    '''
+    groups = []
+    for op in ops:
+        if groups:
+            head, members = groups[-1]
+            if _is_plain_queue(head) and _is_plain_queue(op) and head.postback == op.postback:
+                head.data = {'uri': _uri_list(head) + _uri_list(op)}
+                members.append(op)
+                continue
+
+        if op.op in QUERY_OPS:
+            members = _same_query(groups, op)
+            if members:
+                members.append(op)
+                continue
+
+        groups.append((op, [op]))
+    return groups
+
+def _same_query(groups, op):
+    '''
+    members of an identical query earlier in the burst, unless an op that
+    may change the answer was sent after it
+    '''
+    for head, members in reversed(groups):
+        if head.op not in QUERY_OPS:
+            return None
+        if (head.op, head.data, head.postback) == (op.op, op.data, op.postback):
+            return members
+    return None
+
+def _is_plain_queue(op):
+    return op.op == 'queue' and isinstance(op.data, dict) and list(op.data) == ['uri']
+
+def _uri_list(op):
+    uri = op.data['uri']
+    return uri if isinstance(uri, list) else [uri]
 
 def enclose_packet(op, data=None, postback=None):
     return {
@@ -0,0 +1,324 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+from multiprocessing import reduction
+
+import voice_worker
+from frames import SAMPLES_PER_FRAME
+from player import FRAME_LENGTH
+
+PING_INTERVAL = 2.0
+# a worker that has not answered for this long is killed and replaced
+PING_TIMEOUT = 6.0
+RESPAWN_DELAY = 1.0
+# coordinator stages the worker side of a session waits on
+FORWARDED_STAGES = ('key', 'listening')
+
+
+class RemoteSender:
+    '''
+    udp error count of the FrameSender in the worker, for VoiceHealth
+    '''
+    def __init__(self):
+        self.udp_errors = 0
+
+
+class RemotePlayer:
+    '''
+    coordinator side of a session played by a voice worker
+
+    stands in for Player in Music. the voice it is given is attached to a
+    worker, which gets the udp socket and sends from its own process; the
+    coordinator keeps the voice websocket. flush and rebuffer are
+    forwarded, stats are the ones the worker last reported.
+    '''
+    def __init__(self, pool, session_id, config, lifecycle):
+        self.pool = pool
+        self.session_id = session_id
+        self.lifecycle = lifecycle
+        self.config = {
+            'stream_endpoint': config.stream_endpoint,
+            'aria_token': config.aria_token,
+            'buffer_target_ms': config.buffer_target_ms,
+            'buffer_low_ms': config.buffer_low_ms,
+            'buffer_high_ms': config.buffer_high_ms,
+            'stream_backlog_ms': config.stream_backlog_ms,
+            'backoff': (config.reconnect_delay, config.reconnect_max_delay)
+        }
+        self.sender = None
+        self.worker = None
+        # where the rtp counters are, so another worker can go on from there
+        self.counters = {'sequence': 0, 'timestamp': 0, 'lite_nonce': 0}
+        self._reported_at = None
+        self._voice = None
+        self._attached = None
+        self._stats = {}
+        pool.players[session_id] = self
+
+    @property
+    def voice(self):
+        return self._voice
+
+    @voice.setter
+    def voice(self, voice):
+        self._voice = voice
+        if voice:
+            self.sender = RemoteSender()
+            self.pool.attach(self)
+        else:
+            self.sender = None
+            self.pool.detach(self)
+
+    def start(self):
+        # the worker plays as soon as the voice is attached
+        pass
+
+    def stop(self):
+        self.pool.detach(self)
+
+    def flush(self):
+        self.pool.send(self, {'op': 'flush'})
+
+    def rebuffer(self):
+        self.pool.send(self, {'op': 'rebuffer'})
+
+    def voice_params(self):
+        voice = self._voice
+        counters = dict(self.counters)
+        if self._reported_at is not None:
+            # the old worker went on sending after its last report; go past
+            # that, receivers drop packets with a sequence they already had
+            frames = int((self.pool.loop.time() - self._reported_at) / FRAME_LENGTH) + 1
+            counters['sequence'] = (counters['sequence'] + frames) % 65536
+            counters['timestamp'] = (counters['timestamp'] + frames * SAMPLES_PER_FRAME) % 4294967296
+        return {
+            'mode': voice.mode,
+            'secret_key': voice.secret_key,
+            'ssrc': voice.ssrc,
+            'endpoint_ip': voice.endpoint_ip,
+            'voice_port': voice.voice_port,
+            **counters
+        }
+
+    def voice_changed(self):
+        '''
+        whether discord.py reconnected the voice since it was attached
+        '''
+        voice = self._voice
+        return (voice is not None and self._attached is not None and
+                (voice.secret_key is not self._attached[0] or voice.socket is not self._attached[1]))
+
+    def report(self, stats):
+        self._stats = stats
+        self._reported_at = self.pool.loop.time()
+        for key in self.counters:
+            self.counters[key] = stats.get(key, 0)
+        if self.sender:
+            self.sender.udp_errors = stats.get('udp_errors', 0)
+
+    async def _forward(self, stage):
+        while True:
+            await self.lifecycle.wait(stage)
+            self.pool.send(self, {'op': 'stage', 'stage': stage, 'ready': True, 'key': self.lifecycle.key})
+            await self.lifecycle.wait_cleared(stage)
+            self.pool.send(self, {'op': 'stage', 'stage': stage, 'ready': False})
+
+    async def forward_stages(self):
+        '''
+        tell the worker when the stream key and the listeners come and go
+        '''
+        await asyncio.gather(*[self._forward(stage) for stage in FORWARDED_STAGES])
+
+    def stats(self):
+        return dict(self._stats)
+
+
+class Worker:
+    '''
+    one voice worker process and the pipe to it
+    '''
+    def __init__(self, index, context, loop):
+        self.index = index
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=voice_worker.main, args=(child, index),
+                                       name=f'voice-worker-{index}', daemon=True)
+        self.process.start()
+        child.close()
+        self.started_at = loop.time()
+        self.last_pong = None
+        self.ready = False
+        self.players = set()
+
+
+class WorkerPool:
+    '''
+    voice worker processes and the sessions each one plays
+
+    a session goes to the live worker with the fewest sessions. workers are
+    pinged every `interval` seconds; one that exits, closes its pipe or
+    misses pings for `timeout` seconds is killed, its sessions are moved to
+    the remaining workers right away and a new worker takes its place.
+    '''
+    def __init__(self, loop, size, interval=PING_INTERVAL, timeout=PING_TIMEOUT):
+        self.loop = loop
+        self.size = size
+        self.interval = interval
+        self.timeout = timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {}
+        self.players = {}
+        self.respawns = 0
+        self._seq = itertools.count()
+        self._stopped = False
+
+    def start(self):
+        for index in range(self.size):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        if self._stopped:
+            return
+        worker = self.workers[index] = Worker(index, self.context, self.loop)
+        self.loop.add_reader(worker.conn.fileno(), self._readable, worker)
+        logging.info(f'voice worker {index} started, pid {worker.process.pid}')
+
+    def _readable(self, worker):
+        try:
+            while worker.conn.poll():
+                self._handle(worker, worker.conn.recv())
+        except (EOFError, OSError):
+            self._lost(worker, 'pipe closed')
+
+    def _handle(self, worker, message):
+        op = message.get('op')
+        if op == 'hello':
+            worker.ready = True
+            worker.last_pong = self.loop.time()
+            self._place_orphans()
+        elif op == 'pong':
+            worker.last_pong = self.loop.time()
+            for session_id, stats in message.get('stats').items():
+                player = self.players.get(session_id)
+                if player and player.worker is worker:
+                    player.report(stats)
+
+    def _send(self, worker, message):
+        try:
+            worker.conn.send(message)
+            return True
+        except OSError:
+            self._lost(worker, 'pipe closed')
+            return False
+
+    def send(self, player, message):
+        if player.worker:
+            self._send(player.worker, {**message, 'session': player.session_id})
+
+    def _least_loaded(self):
+        ready = [worker for worker in self.workers.values() if worker.ready]
+        return min(ready, key=lambda worker: len(worker.players)) if ready else None
+
+    def attach(self, player):
+        '''
+        hand the voice of player to its worker, or to the least loaded one
+        '''
+        worker = player.worker if player.worker and player.worker.ready else self._least_loaded()
+        if worker is None:
+            # placed once a worker says hello
+            return
+        if player.worker and player.worker is not worker:
+            self.detach(player)
+
+        voice = player.voice
+        lifecycle = player.lifecycle
+        message = {
+            'op': 'attach',
+            'session': player.session_id,
+            'config': player.config,
+            'voice': player.voice_params(),
+            'key': lifecycle.key,
+            'stages': {stage: lifecycle.is_ready(stage) for stage in FORWARDED_STAGES}
+        }
+        if not self._send(worker, message):
+            return
+        try:
+            # the worker reads the socket right after the message
+            reduction.send_handle(worker.conn, voice.socket.fileno(), worker.process.pid)
+        except OSError:
+            self._lost(worker, 'pipe closed')
+            return
+        player.worker = worker
+        player._attached = (voice.secret_key, voice.socket)
+        worker.players.add(player)
+        logging.info(f'session {player.session_id} on voice worker {worker.index}')
+
+    def detach(self, player):
+        worker = player.worker
+        if worker:
+            worker.players.discard(player)
+            player.worker = None
+            player._attached = None
+            self._send(worker, {'op': 'detach', 'session': player.session_id})
+
+    def _place_orphans(self):
+        for player in self.players.values():
+            if player.voice and player.worker is None:
+                self.attach(player)
+
+    def _lost(self, worker, reason):
+        if self.workers.get(worker.index) is not worker:
+            # already replaced
+            return
+        logging.warning(f'voice worker {worker.index} lost: {reason}, '
+                        f'moving {len(worker.players)} sessions')
+        del self.workers[worker.index]
+        self.loop.remove_reader(worker.conn.fileno())
+        worker.conn.close()
+        if worker.process.is_alive():
+            worker.process.kill()
+        for player in worker.players:
+            player.worker = None
+            player._attached = None
+        worker.players.clear()
+        self._place_orphans()
+
+        self.respawns += 1
+        self.loop.call_later(RESPAWN_DELAY, self._spawn, worker.index)
+
+    async def run(self):
+        '''
+        health checks
+        '''
+        while True:
+            await asyncio.sleep(self.interval)
+            now = self.loop.time()
+            for worker in list(self.workers.values()):
+                if not worker.process.is_alive():
+                    self._lost(worker, f'exited with {worker.process.exitcode}')
+                elif now - (worker.last_pong or worker.started_at) > self.timeout:
+                    self._lost(worker, 'not answering')
+                elif worker.ready:
+                    self._send(worker, {'op': 'ping', 'seq': next(self._seq)})
+
+            for player in self.players.values():
+                if player.worker and player.voice_changed():
+                    logging.info(f'voice of session {player.session_id} changed, attaching it again')
+                    self.attach(player)
+
+    async def stop(self):
+        self._stopped = True
+        for worker in self.workers.values():
+            self.loop.remove_reader(worker.conn.fileno())
+            worker.conn.close()
+            worker.process.terminate()
+        for worker in self.workers.values():
+            await self.loop.run_in_executor(None, worker.process.join, 1.0)
+        self.workers.clear()
+
+    def stats(self):
+        return {
+            'workers': sum(1 for worker in self.workers.values() if worker.ready),
+            'sessions': {worker.index: len(worker.players) for worker in self.workers.values()},
+            'respawns': self.respawns
+        }